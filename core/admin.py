@@ -1,8 +1,11 @@
 from django.contrib import admin
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
+from .exporting import EXPORT_FORMATS, export_lines, export_rows
 from .models import (Address, Category, Coupon, Item, Order, OrderItem,
-                     Payment, Refund, UserProfile)
+                     Payment, PaymentTask, Refund, UserProfile)
 
 
 def make_refund_accepted(modeladmin, request, queryset):
@@ -13,6 +16,39 @@ def make_refund_accepted(modeladmin, request, queryset):
 make_refund_accepted.short_description = "Обновить статус возврата на возврат"
 
 
+def retry_payment_tasks(modeladmin, request, queryset):
+    """Вернуть в очередь задачи, ждущие проверки, после сверки с Stripe.
+    Ключ тот же, поэтому уже прошедшее списание Stripe вернёт, а не
+    повторит (ключи хранятся у Stripe 24 часа)"""
+    count = queryset.filter(status=PaymentTask.REVIEW).update(
+        status=PaymentTask.PENDING, attempts=0, run_after=timezone.now()
+    )
+    modeladmin.message_user(request, f"Возвращено в очередь: {count}")
+
+
+retry_payment_tasks.short_description = "Повторить списание с тем же ключом"
+
+
+def export_orders(file_format):
+    """Action выгрузки выбранных заказов. Ответ отдаётся потоком по мере
+    чтения строк из базы, поэтому размер выгрузки не ограничен памятью"""
+
+    def action(modeladmin, request, queryset):
+        response = StreamingHttpResponse(
+            export_lines(export_rows(queryset), file_format),
+            content_type=EXPORT_FORMATS[file_format],
+        )
+        response["Content-Disposition"] = (
+            'attachment; filename="orders-%s.%s"'
+            % (timezone.now().strftime("%Y%m%d-%H%M%S"), file_format)
+        )
+        return response
+
+    action.__name__ = "export_orders_%s" % file_format
+    action.short_description = "Выгрузить заказы в %s" % file_format.upper()
+    return action
+
+
 @admin.register(Item)
 class ItemAdmin(admin.ModelAdmin):
     list_display = [
@@ -30,6 +66,7 @@ class ItemAdmin(admin.ModelAdmin):
     prepopulated_fields = {"slug": ("title",)}
     readonly_fields = ["get_image"]
     save_as = True
+    list_select_related = ["category"]
 
     fieldsets = (
         (None, {"fields": ("title", "slug", "category", "label")}),
@@ -40,11 +77,25 @@ class ItemAdmin(admin.ModelAdmin):
     def get_image(self, obj):
         if obj.image:
             return mark_safe(
-                f'<img src="{obj.image.url}" width="50px" height="50px"')
+                f'<img src="{obj.get_image_url("thumb")}" width="50px" '
+                f'height="50px">')
         return "---"
 
     get_image.short_description = "Фотография товара"
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        """Список категорий для list_editable загружается один раз на
+        страницу, а не отдельным запросом в каждой строке"""
+        formfield = super().formfield_for_foreignkey(
+            db_field, request, **kwargs
+        )
+        if db_field.name == "category":
+            choices = getattr(request, "_category_choices", None)
+            if choices is None:
+                choices = request._category_choices = list(formfield.choices)
+            formfield.choices = choices
+        return formfield
+
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
@@ -67,6 +118,7 @@ class OrderAdmin(admin.ModelAdmin):
         "received",
         "refund_requested",
         "refund_granted",
+        "payment__timestamp",
     ]
     list_display_links = [
         "user",
@@ -76,12 +128,26 @@ class OrderAdmin(admin.ModelAdmin):
         "shipping_address",
     ]
     search_fields = ["user__username", "ref_code"]
-    actions = [make_refund_accepted]
+    actions = [make_refund_accepted, export_orders("csv"),
+               export_orders("jsonl")]
+    # __str__ адресов и платежа выводит имя пользователя
+    list_select_related = [
+        "user",
+        "billing_address__user",
+        "shipping_address__user",
+        "payment__user",
+        "coupon",
+    ]
 
 
 @admin.register(OrderItem)
 class OrderItemAdmin(admin.ModelAdmin):
     list_display = ["user", "item", "quantity", "ordered"]
+    list_select_related = ["user", "item"]
+
+    def get_queryset(self, request):
+        # select_related загружает все поля товара, вектор поиска не нужен
+        return super().get_queryset(request).defer("item__search_vector")
 
 
 @admin.register(Address)
@@ -96,7 +162,10 @@ class AddressAdmin(admin.ModelAdmin):
         "default",
     ]
     list_filter = ["default", "address_type", "country"]
-    search_fields = ["user", "street_address", "apartment_address", "zip"]
+    search_fields = [
+        "user__username", "street_address", "apartment_address", "zip"
+    ]
+    list_select_related = ["user"]
 
 
 @admin.register(Payment)
@@ -107,6 +176,26 @@ class PaymentAdmin(admin.ModelAdmin):
         "amount",
         "timestamp",
     ]
+    list_select_related = ["user"]
+
+
+@admin.register(PaymentTask)
+class PaymentTaskAdmin(admin.ModelAdmin):
+    list_display = [
+        "idempotency_key",
+        "user",
+        "order",
+        "amount",
+        "status",
+        "attempts",
+        "error",
+        "created_at",
+    ]
+    list_filter = ["status"]
+    search_fields = ["idempotency_key", "user__username"]
+    readonly_fields = ["token", "idempotency_key"]
+    list_select_related = ["user", "order__user"]
+    actions = [retry_payment_tasks]
 
 
 @admin.register(Coupon)
@@ -117,6 +206,7 @@ class CouponAdmin(admin.ModelAdmin):
 @admin.register(Refund)
 class RefundAdmin(admin.ModelAdmin):
     list_display = ["order", "reason", "email", "accepted"]
+    list_select_related = ["order__user"]
 
 
 @admin.register(Category)
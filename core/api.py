@@ -0,0 +1,158 @@
+from collections import OrderedDict
+
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import condition
+from rest_framework import generics
+from rest_framework.pagination import BasePagination
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .cache import (CATALOG_VERSION_KEY, CATEGORIES_VERSION_KEY,
+                    CATEGORY_VERSION_KEY, ITEM_VERSION_KEY, get_categories,
+                    get_version, get_versions, is_replicated)
+from .conditional import make_etag
+from .models import Item
+from .pagination import KeysetPaginator
+from .search import get_search_backend
+from .serializers import CategorySerializer, ItemSerializer
+
+# Меняется при несовместимом изменении ответов (входит в ETag)
+API_VERSION = "v1"
+
+
+class KeysetCursorPagination(BasePagination):
+    """Курсорная пагинация API на KeysetPaginator: порядок задаёт
+    keyset_ordering представления, любая страница стоит как первая"""
+
+    page_size = 20
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        paginator = KeysetPaginator(
+            queryset,
+            self.get_page_size(request),
+            ordering=getattr(view, "keyset_ordering", ("id",)),
+        )
+        self.page = paginator.page(
+            request.query_params.get(self.cursor_query_param)
+        )
+        return list(self.page)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, cursor
+        )
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_link(self.page.next_cursor)),
+            ("previous", self.get_link(self.page.previous_cursor)),
+            ("results", data),
+        ]))
+
+
+class ConditionalGetMixin:
+    """ETag из версий кэша каталога и адреса запроса (курсор, поля, поиск).
+    Совпавший If-None-Match получает 304 до чтения данных из базы и
+    сериализации. Версии меняют сигналы и команды массовой записи"""
+
+    # Каталог открыт всем: без сессий и проверки CSRF
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+
+    version_key = CATALOG_VERSION_KEY
+
+    def get_etag_versions(self):
+        """Версии данных ответа (None - ресурса нет, ETag не нужен)"""
+        return [get_version(self.version_key)]
+
+    def get_etag(self, request, *args, **kwargs):
+        versions = self.get_etag_versions()
+        if versions is None or not all(map(is_replicated, versions)):
+            return None
+        return make_etag(API_VERSION, request.get_full_path(), *versions)
+
+    def get(self, request, *args, **kwargs):
+        view = condition(etag_func=self.get_etag)(super().get)
+        return view(request, *args, **kwargs)
+
+
+class ItemList(ConditionalGetMixin, generics.ListAPIView):
+    """Товары (?category=<slug> - товары категории)"""
+
+    serializer_class = ItemSerializer
+    pagination_class = KeysetCursorPagination
+    keyset_ordering = ("id",)
+
+    def get_queryset(self):
+        queryset = Item.objects.select_related("category")
+        category = self.request.query_params.get("category")
+        if category:
+            queryset = queryset.filter(category__slug=category)
+        return queryset
+
+
+class ItemDetail(ConditionalGetMixin, generics.RetrieveAPIView):
+    """Товар по slug. ETag - по версиям товара и его категории, поэтому
+    проверка If-None-Match стоит один короткий запрос"""
+
+    serializer_class = ItemSerializer
+    lookup_field = "slug"
+
+    def get_queryset(self):
+        return Item.objects.select_related("category")
+
+    def get_etag_versions(self):
+        self.item_key = Item.objects.filter(
+            slug=self.kwargs["slug"]
+        ).values_list("pk", "category_id").first()
+        if self.item_key is None:
+            return None
+        pk, category_id = self.item_key
+        keys = [ITEM_VERSION_KEY % pk, CATEGORY_VERSION_KEY % category_id]
+        versions = get_versions(keys)
+        return [versions[key] for key in keys]
+
+    def get_object(self):
+        if self.item_key is None:
+            return super().get_object()
+        return get_object_or_404(self.get_queryset(), pk=self.item_key[0])
+
+
+class CategoryList(ConditionalGetMixin, generics.ListAPIView):
+    """Все категории с количеством товаров (из кэша, без пагинации)"""
+
+    serializer_class = CategorySerializer
+    pagination_class = None
+    version_key = CATEGORIES_VERSION_KEY
+
+    def get_queryset(self):
+        return get_categories()
+
+
+class ItemSearch(ConditionalGetMixin, generics.ListAPIView):
+    """Поиск товаров (?q=...), по убыванию релевантности"""
+
+    serializer_class = ItemSerializer
+    pagination_class = KeysetCursorPagination
+    keyset_ordering = ("-rank", "id")
+
+    def get_queryset(self):
+        query = self.request.query_params.get("q", "").strip()
+        if not query:
+            return Item.objects.none()
+        queryset = Item.objects.select_related("category")
+        return get_search_backend(queryset.db).search(queryset, query)
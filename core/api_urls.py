@@ -0,0 +1,12 @@
+from django.urls import path
+
+from .api import CategoryList, ItemDetail, ItemList, ItemSearch
+
+app_name = "api"
+
+urlpatterns = [
+    path("items/", ItemList.as_view(), name="item-list"),
+    path("items/<slug:slug>/", ItemDetail.as_view(), name="item-detail"),
+    path("categories/", CategoryList.as_view(), name="category-list"),
+    path("search/", ItemSearch.as_view(), name="search"),
+]
@@ -0,0 +1,133 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.template.loader import render_to_string
+
+from .models import Category
+
+# Данные под версионированными ключами не нужно удалять: после смены версии
+# старые ключи просто перестают читаться и вытесняются по таймауту
+# Версия - время последнего изменения данных в наносекундах, поэтому по
+# ней же страницы каталога отдают Last-Modified
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+# Весь каталог: любой товар или категория
+CATALOG_VERSION_KEY = "catalog:version"
+# Навигация: названия категорий и количество товаров в них
+CATEGORIES_VERSION_KEY = "catalog:categories:version"
+# Товары одной категории (список и счётчики фильтров)
+CATEGORY_ITEMS_VERSION_KEY = "catalog:category:%s:items:version"
+# Версии отдельных товаров и категорий для кэша HTML-фрагментов
+ITEM_VERSION_KEY = "catalog:item:%s:version"
+CATEGORY_VERSION_KEY = "catalog:category:%s:version"
+# Увеличить при изменении шаблонов фрагментов, чтобы не отдавать старую
+# разметку из кэша после выкладки
+FRAGMENTS_VERSION = 2
+
+
+def get_version(key):
+    """Текущая версия набора данных в кэше"""
+    version = cache.get(key)
+    if version is None:
+        # Начальная версия от времени, чтобы после вытеснения ключа версии
+        # не прочитать данные, закэшированные под старым номером
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_versions(keys):
+    """Сменить версии наборов данных (старые ключи становятся недоступны).
+    Новая версия - текущее время, одновременные изменения дают разные,
+    одинаково свежие версии"""
+    cache.set_many(dict.fromkeys(keys, time.time_ns()), None)
+
+
+def is_replicated(version):
+    """Дошли ли данные этой версии до реплик базы (core.routers). До
+    этого их нельзя кэшировать под новой версией: с отстающей реплики
+    могут прочитаться старые данные"""
+    if not settings.DATABASE_REPLICAS:
+        return True
+    return time.time_ns() - version > settings.REPLICA_LAG * 10 ** 9
+
+
+def get_versions(keys):
+    """Текущие версии нескольких наборов данных за один запрос к кэшу"""
+    versions = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in versions}
+    if missing:
+        # Гонка здесь безопасна: любая новая версия от времени свежая,
+        # а фрагмент под проигравшей версией просто не будет прочитан
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return versions
+
+
+def bump_item_versions(pks):
+    """Сбросить версии товаров после массового изменения в обход save().
+    Удалённая версия при следующем чтении заменится новой"""
+    cache.delete_many([ITEM_VERSION_KEY % pk for pk in pks])
+
+
+def bump_catalog_versions():
+    """Сменить версии всех списков товаров после массового изменения в
+    обход save(): каталога, навигации и каждой категории"""
+    bump_versions(
+        [CATALOG_VERSION_KEY, CATEGORIES_VERSION_KEY]
+        + [CATEGORY_ITEMS_VERSION_KEY % pk
+           for pk in Category.objects.values_list("pk", flat=True)]
+    )
+
+
+def render_item_fragments(fragments):
+    """HTML фрагментов товаров (пары шаблон-товар) из кэша.
+
+    Ключ фрагмента включает версии товара и его категории, поэтому
+    изменение товара или переименование категории делает его
+    недоступным. Версии и фрагменты читаются одним get_many, а
+    недостающие фрагменты рендерятся и сохраняются одним set_many
+    """
+    fragments = list(fragments)
+    versions = get_versions(
+        {ITEM_VERSION_KEY % item.pk for _, item in fragments}
+        | {CATEGORY_VERSION_KEY % item.category_id for _, item in fragments}
+    )
+    keys = [
+        "catalog:fragment:%s:%s:%s:%s:%s" % (
+            FRAGMENTS_VERSION, template_name, item.pk,
+            versions[ITEM_VERSION_KEY % item.pk],
+            versions[CATEGORY_VERSION_KEY % item.category_id],
+        )
+        for template_name, item in fragments
+    ]
+    cached = cache.get_many(keys)
+    rendered = {}
+    result = []
+    for key, (template_name, item) in zip(keys, fragments):
+        html = cached.get(key)
+        if html is None:
+            html = render_to_string(template_name, {"item": item})
+            if (is_replicated(versions[ITEM_VERSION_KEY % item.pk])
+                    and is_replicated(
+                        versions[CATEGORY_VERSION_KEY % item.category_id])):
+                rendered[key] = html
+        result.append(html)
+    if rendered:
+        cache.set_many(rendered, CATALOG_CACHE_TIMEOUT)
+    return result
+
+
+def get_categories():
+    """Категории с количеством товаров для навигации каталога"""
+    version = get_version(CATEGORIES_VERSION_KEY)
+    key = f"catalog:categories:{version}"
+    categories = cache.get(key)
+    if categories is None:
+        categories = list(
+            Category.objects.annotate(items_count=Count("items"))
+        )
+        if is_replicated(version):
+            cache.set(key, categories, CATALOG_CACHE_TIMEOUT)
+    return categories
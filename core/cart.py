@@ -0,0 +1,417 @@
+import copy
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import Coupon, Item, Order, OrderItem, PaymentTask
+
+# Результаты операций с корзиной
+ADDED = "added"
+UPDATED = "updated"
+REMOVED = "removed"
+NOT_IN_CART = "not_in_cart"
+NO_ORDER = "no_order"
+
+# Ключ корзины в сессии (SessionCart) и ключ анонимной корзины в кэше
+# (CacheCart). Ключ сессии не подходит: при входе он меняется
+SESSION_KEY = "cart"
+ANONYMOUS_KEY = "cart_token"
+# Блокировка корзины на время изменения (в секундах). Если процесс умер,
+# не сняв блокировку, она истечёт сама
+LOCK_TIMEOUT = 5
+LOCK_POLL_INTERVAL = 0.01
+# Оплачен ли заказ, оформленный из корзины (BaseCart.settle). Чтобы не
+# спрашивать базу на каждой странице до оплаты, ответ "не оплачен"
+# хранится в кэше недолго, а оплату отмечает воркер (mark_order_paid)
+ORDER_PAID_KEY = "cart:order:%s:paid"
+ORDER_UNPAID_TIMEOUT = 60
+
+
+def empty_cart():
+    """Данные пустой корзины. Ключи строк - id товаров строкой, чтобы
+    данные без изменений проходили через JSON-сериализатор сессий.
+    order и placed - заказ, оформленный из корзины, и строки, которые в
+    него попали (до оплаты заказа)"""
+    return {"lines": {}, "coupon": None, "order": None, "placed": {}}
+
+
+class CartSummary:
+    """Корзина для шаблонов: те же поля, что у заказа из with_totals()"""
+
+    def __init__(self, lines, coupon):
+        self.lines = lines
+        self.coupon = coupon
+        self.items_count = len(lines)
+        self.total_item_price = sum(line.total_item_price for line in lines)
+        self.final_price = sum(line.final_price for line in lines)
+        self.amount_saved = self.total_item_price - self.final_price
+        self.coupon_amount = coupon.amount if coupon else 0
+        self.total_sum = self.final_price - self.coupon_amount
+
+    def get_total_sum(self):
+        return self.total_sum
+
+
+class BaseCart:
+    """Корзина посетителя: количество товаров по id и выбранный купон.
+
+    Строки хранятся вне таблиц заказов, поэтому брошенные корзины не
+    оставляют записей в Order и OrderItem, а корзина есть и у анонимного
+    посетителя. Заказ создаётся из корзины только при оформлении
+    (place_order). Корзина хранится целиком, поэтому каждое изменение
+    идёт под блокировкой в кэше (locked): параллельные запросы одного
+    посетителя не теряют строки и количество друг друга
+    """
+
+    def __init__(self, request, user=None):
+        self.request = request
+        self.user = request.user if user is None else user
+        self.data = self.load() or empty_cart()
+        if self.data.get("order"):
+            self.settle()
+
+    def load(self):
+        """Данные корзины из хранилища (None - корзины нет)"""
+        raise NotImplementedError
+
+    def reload(self):
+        """Свежие данные корзины из хранилища, минуя копию запроса"""
+        return self.load()
+
+    def lock_key(self):
+        """Ключ блокировки корзины (None - корзина ещё нигде не хранится,
+        и менять её параллельно некому)"""
+        raise NotImplementedError
+
+    @contextmanager
+    def locked(self):
+        """Изменить корзину под блокировкой: данные перечитываются из
+        хранилища, меняются в блоке with и сохраняются, если изменились.
+        Параллельные запросы ждут снятия блокировки"""
+        key = self.lock_key()
+        token = uuid.uuid4().hex
+        if key is not None:
+            # Ожидание ограничено: чужая блокировка истекает сама
+            while not cache.add(key, token, LOCK_TIMEOUT):
+                time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            self.data = self.reload() or empty_cart()
+            original = copy.deepcopy(self.data)
+            yield self.data
+            if self.data != original:
+                self.store()
+        finally:
+            if key is not None and cache.get(key) == token:
+                cache.delete(key)
+
+    def store(self):
+        """Сохранить self.data в хранилище"""
+        raise NotImplementedError
+
+    def delete(self):
+        """Удалить корзину из хранилища"""
+        raise NotImplementedError
+
+    def lines(self):
+        """Строки корзины: {id товара: количество}"""
+        return {
+            int(item_id): quantity
+            for item_id, quantity in self.data["lines"].items()
+        }
+
+    def count(self):
+        """Количество разных товаров в корзине"""
+        return len(self.data["lines"])
+
+    def add(self, item_id, quantity=1):
+        """Добавить товар в корзину (или увеличить количество)"""
+        key = str(item_id)
+        with self.locked() as data:
+            lines = data["lines"]
+            status = UPDATED if key in lines else ADDED
+            lines[key] = lines.get(key, 0) + quantity
+        return status
+
+    def remove(self, item_id):
+        """Убрать товар из корзины полностью"""
+        with self.locked() as data:
+            if data["lines"].pop(str(item_id), None) is None:
+                return self.missing_item_status()
+        return REMOVED
+
+    def remove_single(self, item_id):
+        """Уменьшить количество товара на 1 (на последней единице - убрать)"""
+        key = str(item_id)
+        with self.locked() as data:
+            lines = data["lines"]
+            if key not in lines:
+                return self.missing_item_status()
+            if lines[key] > 1:
+                lines[key] -= 1
+                return UPDATED
+            del lines[key]
+        return REMOVED
+
+    def missing_item_status(self):
+        """Почему товара нет в корзине (для сообщения пользователю)"""
+        return NOT_IN_CART if self.data["lines"] else NO_ORDER
+
+    def set_coupon(self, coupon_id):
+        with self.locked() as data:
+            data["coupon"] = coupon_id
+
+    def merge(self, data):
+        """Добавить к корзине строки другой корзины"""
+        with self.locked() as own:
+            lines = own["lines"]
+            for key, quantity in data["lines"].items():
+                lines[key] = lines.get(key, 0) + quantity
+            own["coupon"] = own["coupon"] or data["coupon"]
+
+    def settle(self):
+        """Убрать из корзины строки оплаченного заказа. Заказ оплачивает
+        воркер, которому корзина посетителя недоступна, поэтому это
+        делается при первом чтении корзины после оплаты. Товары,
+        добавленные после оформления, остаются в корзине"""
+        order_id = self.data["order"]
+        key = ORDER_PAID_KEY % order_id
+        paid = cache.get(key)
+        if paid is None:
+            paid = Order.objects.filter(pk=order_id, ordered=True).exists()
+            cache.set(key, paid,
+                      settings.CART_TIMEOUT if paid else ORDER_UNPAID_TIMEOUT)
+        if not paid:
+            return
+        with self.locked() as data:
+            if data.get("order") != order_id:
+                return
+            lines = data["lines"]
+            for key, quantity in data["placed"].items():
+                if lines.get(key, 0) > quantity:
+                    lines[key] -= quantity
+                else:
+                    lines.pop(key, None)
+            data.update(order=None, placed={}, coupon=None)
+
+    def clear(self):
+        self.data = empty_cart()
+        self.delete()
+
+    def summary(self):
+        """Корзина с товарами и суммами для шаблонов (None - корзина
+        пуста). Товары читаются одним запросом, купон - вторым"""
+        lines = self.lines()
+        if not lines:
+            return None
+        items = Item.objects.filter(pk__in=lines).order_by("id")
+        order_items = []
+        for item in items:
+            order_item = OrderItem(item=item, quantity=lines[item.pk])
+            order_item.total_item_price = order_item.get_total_item_price()
+            order_item.final_price = order_item.get_final_price()
+            order_item.amount_saved = (
+                order_item.total_item_price - order_item.final_price
+            )
+            order_items.append(order_item)
+        coupon = None
+        if self.data["coupon"]:
+            coupon = Coupon.objects.filter(pk=self.data["coupon"]).first()
+        return CartSummary(order_items, coupon)
+
+    def place_order(self, user, shipping_address_id, billing_address_id):
+        """Записать корзину в таблицы заказов перед оплатой, вернуть id
+        заказа. Если пользователь уже оформлял корзину, но не оплатил,
+        её заказ переиспользуется, а строки заменяются текущими.
+        Пока заказ оплачивается, его не трогают и возвращают None.
+        Число запросов не зависит от количества товаров"""
+        lines = self.lines()
+        with transaction.atomic():
+            order_id = get_open_order_id(user)
+            # Блокировка строки заказа: задача оплаты (enqueue_charge) не
+            # появится, пока строки заменяются. Сумма поставленной задачи
+            # уже посчитана по текущим строкам - их менять нельзя
+            Order.objects.select_for_update().filter(pk=order_id).exists()
+            if PaymentTask.objects.filter(
+                order=order_id, status__in=PaymentTask.IN_PROGRESS
+            ).exists():
+                return None
+            # Товары могли удалить из каталога, пока они лежали в корзине
+            item_ids = Item.objects.filter(pk__in=lines).values_list(
+                "pk", flat=True
+            )
+            coupon_id = Coupon.objects.filter(
+                pk=self.data["coupon"]
+            ).values_list("pk", flat=True).first()
+            Order.objects.filter(pk=order_id).update(
+                ordered_date=timezone.now(),
+                shipping_address_id=shipping_address_id,
+                billing_address_id=billing_address_id,
+                coupon_id=coupon_id,
+            )
+            # Связи со старыми строками удаляются каскадом
+            OrderItem.objects.filter(user=user, ordered=False).delete()
+            OrderItem.objects.bulk_create(
+                OrderItem(user=user, item_id=item_id,
+                          quantity=lines[item_id])
+                for item_id in item_ids
+            )
+            # bulk_create не везде возвращает первичные ключи (SQLite)
+            Order.items.through.objects.bulk_create(
+                Order.items.through(order_id=order_id, orderitem_id=pk)
+                for pk in OrderItem.objects.filter(
+                    user=user, ordered=False
+                ).values_list("pk", flat=True)
+            )
+        # Запомнить, что ушло в заказ: после оплаты это уберёт settle
+        cache.set(ORDER_PAID_KEY % order_id, False, ORDER_UNPAID_TIMEOUT)
+        with self.locked() as data:
+            data["order"] = order_id
+            data["placed"] = {
+                str(item_id): lines[item_id] for item_id in item_ids
+            }
+        return order_id
+
+
+class SessionCart(BaseCart):
+    """Корзина анонимного посетителя в сессии. При входе она переносится в
+    корзину пользователя (CacheCart.merge_anonymous)"""
+
+    def load(self):
+        return self.request.session.get(SESSION_KEY)
+
+    def reload(self):
+        session = self.request.session
+        if session.session_key is None:
+            return self.load()
+        # Копия сессии в запросе прочитана до блокировки
+        return session.__class__(session.session_key).get(SESSION_KEY)
+
+    def lock_key(self):
+        session_key = self.request.session.session_key
+        if session_key is None:
+            return None
+        return "cart:lock:session:%s" % session_key
+
+    def store(self):
+        session = self.request.session
+        session[SESSION_KEY] = self.data
+        if session.session_key is not None:
+            # Сохранить сразу, под блокировкой. Иначе SessionMiddleware
+            # записал бы сессию в конце запроса поверх корзины, которую
+            # тем временем изменил параллельный запрос. Новую сессию
+            # сохранит middleware: без куки параллельных запросов нет
+            session.save()
+            session.modified = False
+
+    def delete(self):
+        self.request.session.pop(SESSION_KEY, None)
+
+
+class CacheCart(BaseCart):
+    """Корзина в кэше (Redis в production). Корзина вошедшего пользователя
+    всегда хранится здесь под его id: она переживает выход и истечение
+    сессии и общая для всех его устройств. Анонимная корзина
+    (CART_BACKEND=cache) привязана к метке в сессии"""
+
+    def key(self, create=False):
+        """Ключ корзины в кэше. Метку анонимной корзины создаёт только
+        запись, чтобы просмотр каталога не создавал сессий"""
+        if self.user.is_authenticated:
+            return "cart:user:%s" % self.user.pk
+        token = self.request.session.get(ANONYMOUS_KEY)
+        if token is None:
+            if not create:
+                return None
+            token = self.request.session[ANONYMOUS_KEY] = uuid.uuid4().hex
+        return "cart:anonymous:%s" % token
+
+    def load(self):
+        key = self.key()
+        return cache.get(key) if key else None
+
+    def lock_key(self):
+        key = self.key()
+        return "cart:lock:%s" % key if key else None
+
+    def store(self):
+        cache.set(self.key(create=True), self.data, settings.CART_TIMEOUT)
+
+    def delete(self):
+        key = self.key()
+        if key:
+            cache.delete(key)
+
+    def merge_anonymous(self):
+        """Перенести в корзину пользователя анонимную корзину из сессии
+        (SessionCart) или из кэша"""
+        session = self.request.session
+        data = session.pop(SESSION_KEY, None)
+        if data:
+            self.merge(data)
+        token = session.pop(ANONYMOUS_KEY, None)
+        if token is None:
+            return
+        key = "cart:anonymous:%s" % token
+        data = cache.get(key)
+        if data:
+            self.merge(data)
+            cache.delete(key)
+
+
+# Хранилища корзины анонимного посетителя (настройка CART_BACKEND)
+BACKENDS = {
+    "session": SessionCart,
+    "cache": CacheCart,
+}
+
+
+def get_cart(request):
+    """Корзина текущего посетителя (одна на запрос)"""
+    if not hasattr(request, "_cart"):
+        if request.user.is_authenticated:
+            request._cart = CacheCart(request)
+            session = request.session
+            # Анонимная корзина осталась в сессии, если вход прошёл мимо
+            # сигнала user_logged_in
+            if SESSION_KEY in session or ANONYMOUS_KEY in session:
+                request._cart.merge_anonymous()
+        else:
+            request._cart = BACKENDS[settings.CART_BACKEND](request)
+    return request._cart
+
+
+def merge_anonymous_cart(request, user):
+    """После входа перечитать корзину уже как корзину пользователя и
+    добавить к ней анонимную"""
+    request._cart = CacheCart(request, user)
+    request._cart.merge_anonymous()
+
+
+def mark_order_paid(order_id):
+    """Отметить оплату заказа для корзины, из которой он оформлен"""
+    cache.set(ORDER_PAID_KEY % order_id, True, settings.CART_TIMEOUT)
+
+
+def open_orders(user):
+    return Order.objects.filter(user=user, ordered=False)
+
+
+def get_open_order_id(user):
+    """id активного заказа пользователя, при отсутствии - создать.
+    Второй активный заказ не даст создать уникальный индекс, поэтому
+    параллельный запрос просто прочитает созданный заказ"""
+    order_id = open_orders(user).values_list("pk", flat=True).first()
+    if order_id is None:
+        try:
+            with transaction.atomic():
+                order_id = Order.objects.create(
+                    user=user, ordered_date=timezone.now()
+                ).pk
+        except IntegrityError:
+            order_id = open_orders(user).values_list("pk", flat=True).get()
+    return order_id
@@ -0,0 +1,100 @@
+import hashlib
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib import messages
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .cache import get_versions, is_replicated
+from .cart import get_cart
+
+
+def make_etag(*parts):
+    """ETag из частей ответа (версий данных, адреса, посетителя)"""
+    key = ":".join(str(part) for part in parts)
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def version_datetime(version):
+    """Время изменения данных по версии из кэша (время в наносекундах)"""
+    return datetime.fromtimestamp(version / 10 ** 9, tz=timezone.utc)
+
+
+class CatalogConditionalMixin:
+    """Условный GET и Cache-Control для страниц каталога.
+
+    Валидаторы считаются по версиям данных в кэше до выборки товаров и
+    рендеринга шаблона, совпавший If-None-Match сразу получает 304.
+    Кроме каталога страница показывает посетителя (имя, число товаров в
+    корзине, сообщения), поэтому:
+
+    - посетитель без сессии получает общую страницу (Cache-Control:
+      public) с Last-Modified, её может кэшировать обратный прокси;
+    - остальным - private, no-cache: браузер каждый раз переспрашивает
+      сервер, а в ETag входят пользователь, корзина и токен CSRF;
+    - при непоказанных сообщениях валидаторов нет, иначе ответ 304
+      скрыл бы сообщение. Их нет и сразу после изменения каталога,
+      пока оно не дошло до реплик базы
+    """
+
+    version_keys = ()
+
+    def get_version_keys(self):
+        """Ключи версий данных, из которых собрана страница"""
+        return self.version_keys
+
+    def get_validators(self):
+        """Версии данных страницы и время её изменения (None - отдать
+        страницу без валидаторов)"""
+        keys = list(self.get_version_keys())
+        versions = get_versions(keys)
+        versions = [versions[key] for key in keys]
+        return versions, version_datetime(max(versions))
+
+    def is_public(self, request):
+        return settings.SESSION_COOKIE_NAME not in request.COOKIES
+
+    def get_etag(self, request, *args, **kwargs):
+        versions, _ = self.validators
+        if self.public:
+            return make_etag(request.get_full_path(), *versions)
+        user = request.user
+        return make_etag(
+            request.get_full_path(), *versions, user.pk,
+            user.get_username(), get_cart(request).count(),
+            request.COOKIES.get(settings.CSRF_COOKIE_NAME, ""),
+        )
+
+    def get_last_modified(self, request, *args, **kwargs):
+        # Время изменения каталога не учитывает корзину и пользователя
+        return self.validators[1] if self.public else None
+
+    def get(self, request, *args, **kwargs):
+        self.public = self.is_public(request)
+        if len(messages.get_messages(request)):
+            self.validators = None
+        else:
+            self.validators = self.get_validators()
+        if self.validators is not None and not all(
+                map(is_replicated, self.validators[0])):
+            # Страница могла собраться из отстающей реплики
+            self.validators = None
+
+        if self.validators is None:
+            response = super().get(request, *args, **kwargs)
+        else:
+            response = condition(
+                etag_func=self.get_etag,
+                last_modified_func=self.get_last_modified,
+            )(super().get)(request, *args, **kwargs)
+
+        if self.public and self.validators is not None:
+            # Браузер переспрашивает сервер (ответ 304 дешёвый), а прокси
+            # отдаёт страницу из своего кэша
+            patch_cache_control(response, public=True, max_age=0,
+                                s_maxage=settings.CATALOG_PAGE_MAX_AGE)
+        else:
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
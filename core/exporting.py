@@ -0,0 +1,108 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import Order
+
+# Столбцы выгрузки: (заголовок, путь от строки связи заказ-товар).
+# Одна строка выгрузки - одна позиция заказа с данными заказа, платежа,
+# пользователя, адресов и купона. Цены - текущие цены товара
+EXPORT_COLUMNS = (
+    ("order_id", "order_id"),
+    ("ref_code", "order__ref_code"),
+    ("start_date", "order__start_date"),
+    ("ordered_date", "order__ordered_date"),
+    ("ordered", "order__ordered"),
+    ("being_delivered", "order__being_delivered"),
+    ("received", "order__received"),
+    ("refund_requested", "order__refund_requested"),
+    ("refund_granted", "order__refund_granted"),
+    ("user_id", "order__user_id"),
+    ("username", "order__user__username"),
+    ("email", "order__user__email"),
+    ("payment_id", "order__payment_id"),
+    ("stripe_charge_id", "order__payment__stripe_charge_id"),
+    ("payment_amount", "order__payment__amount"),
+    ("payment_timestamp", "order__payment__timestamp"),
+    ("coupon_code", "order__coupon__code"),
+    ("coupon_amount", "order__coupon__amount"),
+    ("shipping_street", "order__shipping_address__street_address"),
+    ("shipping_apartment", "order__shipping_address__apartment_address"),
+    ("shipping_country", "order__shipping_address__country"),
+    ("shipping_zip", "order__shipping_address__zip"),
+    ("billing_street", "order__billing_address__street_address"),
+    ("billing_apartment", "order__billing_address__apartment_address"),
+    ("billing_country", "order__billing_address__country"),
+    ("billing_zip", "order__billing_address__zip"),
+    ("order_item_id", "orderitem_id"),
+    ("item_id", "orderitem__item_id"),
+    ("item_slug", "orderitem__item__slug"),
+    ("item_title", "orderitem__item__title"),
+    ("quantity", "orderitem__quantity"),
+    ("price", "orderitem__item__price"),
+    ("discount_price", "orderitem__item__discount_price"),
+)
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson; charset=utf-8",
+}
+
+
+def day_range(date_from=None, date_to=None):
+    """Границы дат (включительно) как полуинтервал времени для индекса
+    по Payment.timestamp: {"gte": ..., "lt": ...}"""
+    bounds = {}
+    if date_from:
+        bounds["gte"] = timezone.make_aware(datetime.combine(date_from,
+                                                             time.min))
+    if date_to:
+        bounds["lt"] = timezone.make_aware(
+            datetime.combine(date_to + timedelta(days=1), time.min)
+        )
+    return bounds
+
+
+def export_rows(orders=None, paid_from=None, paid_to=None, chunk_size=2000):
+    """Строки выгрузки без накопления в памяти.
+
+    Django 2.2 не применяет prefetch_related вместе с iterator(), поэтому
+    обходится таблица связи заказ-товар, а заказ, платёж, пользователь,
+    адреса, купон и товар присоединяются в том же запросе. Строки читаются
+    кортежами через серверный курсор (в PostgreSQL) по chunk_size штук
+    """
+    lines = Order.items.through.objects.all()
+    if orders is not None:
+        lines = lines.filter(order__in=orders.values("pk"))
+    for lookup, value in day_range(paid_from, paid_to).items():
+        lines = lines.filter(**{"order__payment__timestamp__%s" % lookup:
+                                value})
+    return lines.order_by("order_id", "id").values_list(
+        *(path for _, path in EXPORT_COLUMNS)
+    ).iterator(chunk_size=chunk_size)
+
+
+class Echo:
+    """Файл для csv.writer, который возвращает строку вместо записи"""
+
+    def write(self, value):
+        return value
+
+
+def export_lines(rows, file_format="csv"):
+    """Текст выгрузки построчно (для файла или StreamingHttpResponse)"""
+    header = [name for name, _ in EXPORT_COLUMNS]
+    if file_format == "csv":
+        writer = csv.writer(Echo())
+        yield writer.writerow(header)
+        for row in rows:
+            yield writer.writerow(
+                value.isoformat() if isinstance(value, datetime) else value
+                for value in row
+            )
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(header, row)), cls=DjangoJSONEncoder,
+                             ensure_ascii=False) + "\n"
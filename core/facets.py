@@ -0,0 +1,150 @@
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Coalesce
+
+from .models import LABEL_CHOICES, CategoryFacet, Item
+
+# Диапазоны цены продажи (цена со скидкой, если она есть), в $
+PRICE_RANGES = (
+    ("0-100", 0, 100),
+    ("100-500", 100, 500),
+    ("500-1000", 500, 1000),
+    ("1000-5000", 1000, 5000),
+    ("5000-", 5000, None),
+)
+DISCOUNTED = "discounted"
+LABELS = dict(sorted(LABEL_CHOICES))
+
+
+def price_range(price):
+    """Ключ диапазона, в который попадает цена"""
+    for key, low, high in PRICE_RANGES:
+        if high is None or price < high:
+            return key
+    return PRICE_RANGES[-1][0]
+
+
+def item_facets(category_id, label, price, discount_price):
+    """Пары (категория, фасет), в которые входит товар с такими полями"""
+    facets = {"label:%s" % label, "price:%s" % price_range(
+        discount_price or price)}
+    if discount_price:
+        facets.add(DISCOUNTED)
+    return {(category_id, facet) for facet in facets}
+
+
+def stored_facets(pk):
+    """Фасеты товара по данным из базы (до сохранения изменений)"""
+    row = Item.objects.filter(pk=pk).values(
+        "category_id", "label", "price", "discount_price"
+    ).first()
+    return item_facets(**row) if row else set()
+
+
+def update_facets(old, new):
+    """Изменить счётчики на разницу между старыми и новыми фасетами"""
+    changes = Counter(new - old)
+    changes.subtract(old - new)
+    for (category_id, facet), delta in changes.items():
+        facets = CategoryFacet.objects.filter(
+            category_id=category_id, facet=facet
+        )
+        if facets.update(count=F("count") + delta) or delta < 0:
+            continue
+        try:
+            with transaction.atomic():
+                CategoryFacet.objects.create(
+                    category_id=category_id, facet=facet, count=delta
+                )
+        except IntegrityError:
+            # Строку успел создать параллельный запрос
+            facets.update(count=F("count") + delta)
+
+
+def rebuild_facets():
+    """Пересчитать все счётчики заново (после массовых изменений товаров
+    в обход save(): bulk_create, update, импорт)"""
+    counts = Counter()
+    for row in Item.objects.values("category_id", "label").annotate(
+            count=Count("id")).order_by():
+        counts[row["category_id"], "label:%s" % row["label"]] = row["count"]
+    for row in Item.objects.filter(discount_price__isnull=False).values(
+            "category_id").annotate(count=Count("id")).order_by():
+        counts[row["category_id"], DISCOUNTED] = row["count"]
+    selling = Item.objects.annotate(
+        selling_price=Coalesce("discount_price", "price")
+    )
+    for key, low, high in PRICE_RANGES:
+        items = selling.filter(selling_price__gte=low)
+        if high is not None:
+            items = items.filter(selling_price__lt=high)
+        for row in items.values("category_id").annotate(
+                count=Count("id")).order_by():
+            counts[row["category_id"], "price:%s" % key] = row["count"]
+
+    with transaction.atomic():
+        CategoryFacet.objects.all().delete()
+        CategoryFacet.objects.bulk_create(
+            CategoryFacet(category_id=category_id, facet=facet, count=count)
+            for (category_id, facet), count in counts.items()
+        )
+    return len(counts)
+
+
+def parse_filters(params):
+    """Выбранные фильтры из GET-параметров (неизвестные значения
+    отбрасываются)"""
+    prices = {key for key, _, _ in PRICE_RANGES}
+    return {
+        "label": [label for label in params.getlist("label")
+                  if label in LABELS],
+        "price": params.get("price") if params.get("price") in prices
+        else "",
+        "discounted": params.get("discounted") == "1",
+    }
+
+
+def filter_items(queryset, filters):
+    """Применить фильтры к списку товаров (по индексам категории)"""
+    if filters["label"]:
+        queryset = queryset.filter(label__in=filters["label"])
+    if filters["discounted"]:
+        queryset = queryset.filter(discount_price__isnull=False)
+    if filters["price"]:
+        _, low, high = next(
+            price for price in PRICE_RANGES if price[0] == filters["price"]
+        )
+        # Цена продажи без Coalesce, чтобы работали индексы по цене и скидке
+        full_price = Q(discount_price__isnull=True, price__gte=low)
+        discount = Q(discount_price__gte=low)
+        if high is not None:
+            full_price &= Q(price__lt=high)
+            discount &= Q(discount_price__lt=high)
+        queryset = queryset.filter(full_price | discount)
+    return queryset
+
+
+def category_facets(category_id, filters):
+    """Значения фильтров категории со счётчиками для шаблона (один запрос)"""
+    counts = dict(
+        CategoryFacet.objects.filter(category_id=category_id)
+        .values_list("facet", "count")
+    )
+    return {
+        "labels": [
+            {"value": label, "name": name,
+             "count": counts.get("label:%s" % label, 0),
+             "selected": label in filters["label"]}
+            for label, name in LABELS.items()
+        ],
+        "prices": [
+            {"value": key, "name": key if high else "от %s" % low,
+             "count": counts.get("price:%s" % key, 0),
+             "selected": key == filters["price"]}
+            for key, low, high in PRICE_RANGES
+        ],
+        "discounted": {"count": counts.get(DISCOUNTED, 0),
+                       "selected": filters["discounted"]},
+    }
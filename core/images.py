@@ -0,0 +1,77 @@
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# Производные изображения товара: имя -> ширина. Картинка приводится к
+# этой ширине с сохранением пропорций, но не шире оригинала: увеличенная
+# копия весила бы больше оригинала. Ширина из srcset (400w) должна
+# совпадать с настоящей, иначе браузер выберет не ту копию
+IMAGE_SIZES = {
+    "thumb": 100,
+    "card": 400,
+    "detail": 1000,
+}
+# Расширение -> формат Pillow. WebP для современных браузеров, JPEG - запасной
+IMAGE_FORMATS = {
+    "webp": "WEBP",
+    "jpg": "JPEG",
+}
+IMAGE_QUALITY = 82
+
+
+def derivative_name(image_name, size, ext):
+    """Путь производного изображения:
+    item_photos/derivatives/<имя с расширением>-<размер>. Расширение
+    оригинала остаётся в имени, чтобы копии x.jpg и x.png не совпали"""
+    directory, filename = os.path.split(image_name)
+    return f"{directory}/derivatives/{filename}-{size}.{ext}"
+
+
+def derivative_url(image_name, size, ext):
+    return default_storage.url(derivative_name(image_name, size, ext))
+
+
+def derivative_widths(source_width):
+    """Настоящая ширина копий {размер: ширина} для оригинала такой ширины"""
+    return {
+        size: min(width, source_width) for size, width in IMAGE_SIZES.items()
+    }
+
+
+def srcset(image_name, ext, source_width):
+    """srcset из копий в одном формате. Копии узкого оригинала одной
+    ширины попадают в srcset один раз"""
+    candidates = {}
+    for size, width in derivative_widths(source_width).items():
+        candidates.setdefault(width, derivative_url(image_name, size, ext))
+    return ", ".join(f"{url} {width}w" for width, url in candidates.items())
+
+
+def generate_derivatives(image_name):
+    """Сгенерировать все размеры и форматы для загруженного изображения.
+    Возвращает ширину оригинала (для srcset)"""
+    with default_storage.open(image_name, "rb") as file:
+        source = Image.open(file)
+        source.load()
+    source = ImageOps.exif_transpose(source)
+    if source.mode != "RGB":
+        # У JPEG нет прозрачности - подложить белый фон
+        background = Image.new("RGB", source.size, (255, 255, 255))
+        source = source.convert("RGBA")
+        background.paste(source, mask=source.split()[-1])
+        source = background
+
+    for size, width in derivative_widths(source.width).items():
+        height = max(1, round(source.height * width / source.width))
+        image = source.resize((width, height), Image.LANCZOS)
+        for ext, image_format in IMAGE_FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, image_format, quality=IMAGE_QUALITY)
+            name = derivative_name(image_name, size, ext)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            default_storage.save(name, ContentFile(buffer.getvalue()))
+    return source.width
@@ -0,0 +1,301 @@
+import csv
+import json
+import math
+import os
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.utils.text import slugify
+
+from .facets import LABELS
+from .models import Category, Item
+
+# Транслитерация кириллицы для slug (slugify оставляет только латиницу)
+TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e",
+    "ж": "zh", "з": "z", "и": "i", "й": "y", "к": "k", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+})
+# Длина основы slug: остаток поля (50 символов) - под суффикс -<номер>
+SLUG_BASE_LENGTH = 40
+
+# Строк в одном INSERT (в PostgreSQL не больше 65535 параметров в запросе)
+UPSERT_BATCH_SIZE = 1000
+
+# Поля товара, которые записывает импорт
+ITEM_FIELDS = ("title", "description", "price", "discount_price",
+               "category_id", "label", "slug", "image", "image_derivatives",
+               "updated_at")
+
+
+def slug_base(text, default="item"):
+    """slug из названия на русском или латинице"""
+    slug = slugify(text.lower().translate(TRANSLIT))
+    return slug[:SLUG_BASE_LENGTH].strip("-") or default
+
+
+def read_rows(path, file_format=None):
+    """Строки файла по одной (номер строки, словарь полей), без чтения
+    всего файла в память. Формат - csv или jsonl, по умолчанию по
+    расширению файла"""
+    file_format = file_format or os.path.splitext(path)[1].lstrip(".")
+    with open(path, encoding="utf-8-sig", newline="") as file:
+        if file_format == "csv":
+            # Номер строки с учётом заголовка
+            for line, row in enumerate(csv.DictReader(file), start=2):
+                yield line, row
+        elif file_format in ("jsonl", "ndjson"):
+            for line, text in enumerate(file, start=1):
+                if not text.strip():
+                    continue
+                try:
+                    row = json.loads(text)
+                except ValueError:
+                    # Ошибка одной строки не останавливает импорт
+                    row = None
+                yield line, row
+        else:
+            raise ValueError("Неизвестный формат файла: %s" % file_format)
+
+
+def parse_row(row):
+    """Поля товара из строки файла. ValueError - строка с ошибкой"""
+    if not isinstance(row, dict):
+        raise ValueError("строка не является объектом JSON")
+    title = (row.get("title") or "").strip()
+    category = (row.get("category") or "").strip()
+    if not title or not category:
+        raise ValueError("нет названия или категории")
+    price = float(row.get("price") or 0)
+    discount_price = row.get("discount_price")
+    discount_price = float(discount_price) if discount_price else None
+    # float() принимает nan и inf, а сравнение с nan всегда ложно
+    if not math.isfinite(price) or (
+            discount_price is not None
+            and not math.isfinite(discount_price)):
+        raise ValueError("цена не является числом")
+    if price < 1 or (discount_price is not None and discount_price < 1):
+        raise ValueError("цена меньше 1")
+    label = (row.get("label") or "P").strip().upper()
+    if label not in LABELS:
+        raise ValueError("неизвестная этикетка %s" % label)
+    return {
+        "title": title[:100],
+        "description": row.get("description") or "",
+        "price": price,
+        "discount_price": discount_price,
+        "category": category[:50],
+        "label": label,
+        # Пустой slug будет сгенерирован из названия
+        "slug": slugify(
+            (row.get("slug") or "").lower().translate(TRANSLIT)
+        )[:50],
+        "image": (row.get("image") or "").strip(),
+    }
+
+
+class SlugAllocator:
+    """Уникальные slug для пачки названий.
+
+    Занятые slug проверяются одним запросом на всю пачку, кандидаты с
+    суффиксами для совпавших - следующим, и так до конца. Выданные за
+    импорт slug и последние суффиксы хранятся в памяти, поэтому
+    одинаковые названия в файле не проверяют одни и те же номера заново
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.used = set()
+        self.suffixes = {}
+
+    def reserve(self, slugs):
+        """Отметить slug, заданные в файле явно"""
+        self.used.update(slugs)
+
+    def allocate(self, texts):
+        bases = [slug_base(text) for text in texts]
+        slugs = [None] * len(bases)
+        candidates = dict(enumerate(bases))
+        while candidates:
+            taken = set(
+                self.model.objects.filter(slug__in=set(candidates.values()))
+                .values_list("slug", flat=True)
+            )
+            retry = {}
+            for index, slug in candidates.items():
+                if slug in taken or slug in self.used:
+                    base = bases[index]
+                    number = self.suffixes.get(base, 2)
+                    self.suffixes[base] = number + 1
+                    retry[index] = "%s-%s" % (base, number)
+                else:
+                    self.used.add(slug)
+                    slugs[index] = slug
+            candidates = retry
+        return slugs
+
+
+class ItemSlugResolver:
+    """slug товаров для строк без slug в файле.
+
+    Такой товар определяется названием и категорией: если товар с ними
+    уже есть, строка обновляет его, иначе slug генерируется из названия.
+    Поэтому повторный импорт файла без колонки slug не создаёт копии
+    товаров с суффиксами. Переименованный в файле товар станет новым
+    товаром - чтобы переименовывать, нужна колонка slug
+    """
+
+    def __init__(self):
+        self.slugs = {}
+        self.allocator = SlugAllocator(Item)
+
+    def reserve(self, slugs):
+        """Отметить slug, заданные в файле явно"""
+        self.allocator.reserve(slugs)
+
+    def resolve(self, keys):
+        """slug для ключей (название, id категории), в том же порядке"""
+        missing = set(keys) - set(self.slugs)
+        if missing:
+            # Одно название в одной категории может быть у нескольких
+            # товаров - берётся первый
+            for title, category_id, slug in Item.objects.filter(
+                    title__in={title for title, _ in missing}).order_by(
+                    "-id").values_list("title", "category_id", "slug"):
+                if (title, category_id) in missing:
+                    self.slugs[title, category_id] = slug
+            missing -= set(self.slugs)
+        if missing:
+            missing = sorted(missing)
+            slugs = self.allocator.allocate([title for title, _ in missing])
+            self.slugs.update(zip(missing, slugs))
+        return [self.slugs[key] for key in keys]
+
+
+class CategoryResolver:
+    """id категорий по названиям: известные - из памяти, остальные одним
+    запросом на пачку, отсутствующие создаются одним bulk_create"""
+
+    def __init__(self):
+        self.ids = {}
+        self.slugs = SlugAllocator(Category)
+        self.created = 0
+
+    def resolve(self, names):
+        missing = set(names) - set(self.ids)
+        if missing:
+            # Названия категорий не уникальны - берётся первая
+            for pk, name in Category.objects.filter(
+                    name__in=missing).order_by("-id").values_list(
+                    "pk", "name"):
+                self.ids[name] = pk
+            missing -= set(self.ids)
+        if missing:
+            missing = sorted(missing)
+            slugs = self.slugs.allocate(missing)
+            Category.objects.bulk_create(
+                Category(name=name, slug=slug)
+                for name, slug in zip(missing, slugs)
+            )
+            # bulk_create не везде возвращает первичные ключи (SQLite)
+            for pk, name in Category.objects.filter(
+                    slug__in=slugs).values_list("pk", "name"):
+                self.ids[name] = pk
+            self.created += len(missing)
+        return self.ids
+
+
+class ImageLoader:
+    """Изображения товаров из каталога на диске в хранилище медиафайлов.
+    Уже загруженный файл с тем же именем не копируется повторно"""
+
+    upload_to = "item_photos/imported"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.loaded = {}
+
+    def load(self, filename):
+        """Имя файла в хранилище ("" - изображения нет)"""
+        if not filename or not self.directory:
+            return ""
+        if filename not in self.loaded:
+            name = "%s/%s" % (self.upload_to, os.path.basename(filename))
+            if not default_storage.exists(name):
+                path = os.path.join(self.directory, filename)
+                if not os.path.isfile(path):
+                    raise ValueError("нет файла изображения %s" % filename)
+                with open(path, "rb") as file:
+                    name = default_storage.save(name, File(file))
+            self.loaded[filename] = name
+        return self.loaded[filename]
+
+
+def supports_upsert():
+    """Есть ли INSERT ... ON CONFLICT DO UPDATE (Django 2.2 его не
+    генерирует: update_conflicts у bulk_create появился в 4.1)"""
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        return connection.Database.sqlite_version_info >= (3, 24)
+    return False
+
+
+def upsert_items(rows):
+    """Вставить товары, а существующие (по slug) обновить. Изображение
+    существующего товара не меняется, если в строке его нет"""
+    fields = [Item._meta.get_field(name) for name in ITEM_FIELDS]
+    if not supports_upsert():
+        bulk_upsert_items(rows)
+        return
+    quote = connection.ops.quote_name
+    table = quote(Item._meta.db_table)
+    columns = ", ".join(quote(field.column) for field in fields)
+    updates = [
+        "%s = EXCLUDED.%s" % (quote(name), quote(name))
+        for name in ITEM_FIELDS
+        if name not in ("slug", "image", "image_derivatives")
+    ]
+    updates.append(
+        "{image} = COALESCE(NULLIF(EXCLUDED.{image}, ''), {table}.{image})"
+        .format(image=quote("image"), table=table)
+    )
+    placeholders = "(%s)" % ", ".join(["%s"] * len(fields))
+    batch_size = max(min(
+        connection.ops.bulk_batch_size(fields, rows), UPSERT_BATCH_SIZE
+    ), 1)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cursor.execute(
+                "INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s) "
+                "DO UPDATE SET %s" % (
+                    table, columns, ", ".join([placeholders] * len(batch)),
+                    quote("slug"), ", ".join(updates),
+                ),
+                [row[name] for row in batch for name in ITEM_FIELDS],
+            )
+
+
+def bulk_upsert_items(rows):
+    """То же для баз без ON CONFLICT: bulk_update + bulk_create"""
+    existing = Item.objects.in_bulk(
+        [row["slug"] for row in rows], field_name="slug"
+    )
+    new, changed = [], []
+    for row in rows:
+        item = existing.get(row["slug"])
+        if item is None:
+            new.append(Item(**row))
+            continue
+        for name in ITEM_FIELDS:
+            if name not in ("image", "image_derivatives") or row["image"]:
+                setattr(item, name, row[name])
+        changed.append(item)
+    Item.objects.bulk_update(changed, [
+        name for name in ITEM_FIELDS if name != "image_derivatives"
+    ])
+    Item.objects.bulk_create(new)
@@ -0,0 +1,78 @@
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core.models import Category, Item, Order, OrderItem, PaymentTask
+from core.payments import finalize_order
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    """Замер оформления оплаченного заказа для корзин разного размера.
+    Все данные создаются в транзакции, которая откатывается"""
+
+    help = "Бенчмарк оформления заказа после оплаты"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[1, 10, 100, 1000],
+            help="Размеры корзин (количество товаров)",
+        )
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write(f"{'товаров':>8} {'запросов':>9} {'мс':>9}")
+        for size in kwargs["sizes"]:
+            with transaction.atomic():
+                task = self.create_paid_cart(size)
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    finalize_order(task, "ch_benchmark")
+                    elapsed = (time.perf_counter() - started) * 1000
+                if not Order.objects.get(pk=task.order_id).ordered:
+                    raise CommandError("Заказ не оформлен")
+                transaction.set_rollback(True)
+            self.stdout.write(f"{size:>8} {len(queries):>9} {elapsed:>9.2f}")
+
+    def create_paid_cart(self, size):
+        """Корзина из size товаров с задачей оплаты"""
+        prefix = uuid.uuid4().hex[:8]
+        user = User.objects.create(username=f"bench-{prefix}")
+        category = Category.objects.create(name=prefix, slug=prefix)
+        Item.objects.bulk_create(
+            Item(
+                title=f"{prefix} {number}",
+                description=prefix,
+                price=10,
+                category=category,
+                label="P",
+                slug=f"{prefix}-{number}",
+                image="item_photos/benchmark.jpg",
+            )
+            for number in range(size)
+        )
+        OrderItem.objects.bulk_create(
+            OrderItem(user=user, item_id=item_id)
+            for item_id in Item.objects.filter(
+                category=category).values_list("pk", flat=True)
+        )
+        order = Order.objects.create(user=user, ordered_date=timezone.now())
+        Order.items.through.objects.bulk_create(
+            Order.items.through(order_id=order.pk, orderitem_id=item_id)
+            for item_id in OrderItem.objects.filter(
+                user=user).values_list("pk", flat=True)
+        )
+        return PaymentTask.objects.create(
+            user=user,
+            order=order,
+            token="tok_benchmark",
+            amount=size * 1000,
+            idempotency_key=uuid.uuid4().hex,
+            # Оформляет заказ воркер, забравший задачу в обработку
+            status=PaymentTask.PROCESSING,
+        )
@@ -0,0 +1,359 @@
+import json
+import os
+import random
+import statistics
+import uuid
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import Client
+from django.test.utils import (override_settings, setup_test_environment,
+                               teardown_test_environment)
+from django.urls import reverse
+from django.utils import timezone
+
+from core.metrics import measure, percentile
+from core.models import (Address, Category, Item, Order, OrderItem, Payment,
+                         Refund)
+from core.seeding import item_title
+
+User = get_user_model()
+
+DEFAULT_BASELINE = os.path.join(settings.BASE_DIR, "benchmarks",
+                                "baseline.json")
+# Модели, списки которых в админке проверяются на запросы по строкам
+ADMIN_MODELS = (Order, OrderItem, Address, Payment, Refund, Item)
+# Размер короткой страницы для сравнения с полной
+SMALL_PAGE = 10
+
+
+class Command(BaseCommand):
+    """Бенчмарк страниц магазина через тестовый клиент Django.
+
+    Данные создаются в транзакции, которая откатывается, а кэш подменяется
+    на локальный, так что рабочая база и Redis не меняются. Результат
+    сравнивается с сохранённым базовым файлом: рост числа запросов или
+    медианы времени сверх допуска считается регрессией. Кроме того, списки
+    админки на 10 и на 100 строк должны выполнять одинаковое число
+    запросов - это проверяется без базового файла
+    """
+
+    help = "Замерить время ответа и число SQL-запросов страниц магазина"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--iterations", type=int, default=20,
+            help="Сколько раз запрашивать каждую страницу",
+        )
+        parser.add_argument(
+            "--warmup", type=int, default=2,
+            help="Прогревочные запросы (не учитываются)",
+        )
+        parser.add_argument(
+            "--items", type=int, default=2000,
+            help="Количество товаров в тестовом каталоге",
+        )
+        parser.add_argument(
+            "--categories", type=int, default=20,
+            help="Количество категорий",
+        )
+        parser.add_argument(
+            "--orders", type=int, default=100,
+            help="Количество оплаченных заказов у пользователя",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=42,
+            help="Зерно генератора тестовых данных",
+        )
+        parser.add_argument(
+            "--baseline", default=DEFAULT_BASELINE,
+            help="Файл с базовыми результатами",
+        )
+        parser.add_argument(
+            "--update-baseline", action="store_true",
+            help="Записать результаты как новые базовые",
+        )
+        parser.add_argument(
+            "--latency-tolerance", type=float, default=2.0,
+            help="Во сколько раз p50 может превысить базовый (0 - не "
+                 "сравнивать время)",
+        )
+
+    def handle(self, *args, **kwargs):
+        middleware = [
+            name for name in settings.MIDDLEWARE if "debug_toolbar" not in name
+        ]
+        caches = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "benchmark-%s" % uuid.uuid4().hex,
+            }
+        }
+        # Страницам не нужен манифест collectstatic
+        storage = "django.contrib.staticfiles.storage.StaticFilesStorage"
+        setup_test_environment()
+        try:
+            with override_settings(MIDDLEWARE=middleware, CACHES=caches,
+                                   STATICFILES_STORAGE=storage):
+                with transaction.atomic():
+                    results, growth = self.run(kwargs)
+                    transaction.set_rollback(True)
+        finally:
+            teardown_test_environment()
+
+        self.report(results)
+        if growth:
+            # Запросы на каждую строку - ошибка даже при записи нового
+            # базового файла
+            raise CommandError(
+                "Запросы на каждую строку:\n" + "\n".join(growth)
+            )
+        if kwargs["update_baseline"]:
+            self.save_baseline(kwargs["baseline"], results)
+            return
+        self.compare(kwargs["baseline"], results, kwargs["latency_tolerance"])
+
+    def run(self, options):
+        data = self.seed(random.Random(options["seed"]), options)
+        client = Client()
+        client.force_login(data["user"])
+        # Корзина хранится вне базы (сессия или кэш) и наполняется запросами
+        for item, quantity in data["cart"]:
+            client.post(reverse("core:add-to-cart", args=[item.slug]),
+                        {"amount": quantity})
+        admin_client = Client()
+        admin_client.force_login(data["admin"])
+        endpoints = [
+            (client, endpoint) for endpoint in self.endpoints(data)
+        ] + [
+            (admin_client, endpoint) for endpoint in self.admin_endpoints()
+        ]
+
+        samples = {}
+        for iteration in range(options["warmup"] + options["iterations"]):
+            for client, (name, method, url, params) in endpoints:
+                with measure() as sample:
+                    response = getattr(client, method)(url, params)
+                if response.status_code >= 400:
+                    raise CommandError(
+                        "%s вернул %s" % (name, response.status_code)
+                    )
+                if iteration >= options["warmup"]:
+                    samples.setdefault(name, []).append(sample)
+
+        results = {
+            name: {
+                "queries": max(sample.queries for sample in endpoint),
+                "p50_ms": round(statistics.median(
+                    sample.latency * 1000 for sample in endpoint), 2),
+                "p95_ms": round(percentile(
+                    [sample.latency * 1000 for sample in endpoint], 95), 2),
+            }
+            for name, endpoint in samples.items()
+        }
+        return results, self.admin_query_growth(admin_client)
+
+    def endpoints(self, data):
+        """Страницы в порядке обхода: (имя, метод, адрес, параметры).
+        Изменения корзины идут циклом добавить/уменьшить/убрать, поэтому
+        каждая итерация начинается с одинакового состояния"""
+        product = data["product"].slug
+        return (
+            ("core:home", "get", reverse("core:home"), {}),
+            ("core:category", "get",
+             reverse("core:category", args=[data["category"].slug]), {}),
+            ("core:search", "get", reverse("core:search"),
+             {"q": data["query"]}),
+            ("core:product", "get",
+             reverse("core:product", args=[product]), {}),
+            ("core:order-summary", "get", reverse("core:order-summary"), {}),
+            ("core:checkout", "get", reverse("core:checkout"), {}),
+            # Оформление с адресами по умолчанию (заказ из корзины
+            # переписывается, поэтому запрос можно повторять)
+            ("core:checkout:post", "post", reverse("core:checkout"),
+             {"use_default_shipping": "on", "use_default_billing": "on",
+              "payment_option": "S"}),
+            ("core:profile", "get", reverse("core:profile"), {}),
+            ("core:add-to-cart", "post",
+             reverse("core:add-to-cart", args=[product]), {"amount": 2}),
+            ("core:remove_single_item_from_cart", "get",
+             reverse("core:remove_single_item_from_cart", args=[product]),
+             {}),
+            ("core:remove-from-cart", "get",
+             reverse("core:remove-from-cart", args=[product]), {}),
+        )
+
+    def admin_endpoints(self):
+        """Списки админки: в каждом не меньше страницы (100 строк), чтобы
+        запросы на каждую строку сразу были видны по числу запросов"""
+        return [
+            ("admin:core_%s_changelist" % model._meta.model_name, "get",
+             reverse("admin:core_%s_changelist" % model._meta.model_name),
+             {})
+            for model in ADMIN_MODELS
+        ]
+
+    def admin_query_growth(self, client):
+        """Сравнить число запросов списков админки на короткой и на полной
+        странице. Вернуть описания списков, где запросов стало больше"""
+        growth = []
+        for model, (name, method, url, params) in zip(
+                ADMIN_MODELS, self.admin_endpoints()):
+            model_admin = admin.site._registry[model]
+            per_page = model_admin.list_per_page
+            queries = {}
+            try:
+                for size in (SMALL_PAGE, per_page):
+                    model_admin.list_per_page = size
+                    with measure() as sample:
+                        getattr(client, method)(url, params)
+                    queries[size] = sample.queries
+            finally:
+                model_admin.list_per_page = per_page
+            if queries[per_page] > queries[SMALL_PAGE]:
+                growth.append(
+                    f"{name}: {queries[SMALL_PAGE]} запросов на "
+                    f"{SMALL_PAGE} строк, {queries[per_page]} на {per_page}"
+                )
+        return growth
+
+    def seed(self, rng, options):
+        """Каталог, пользователь с адресами, историей заказов и товары
+        для корзины"""
+        prefix = uuid.uuid4().hex[:8]
+        Category.objects.bulk_create(
+            Category(name=f"Категория {number}", slug=f"{prefix}-c{number}")
+            for number in range(options["categories"])
+        )
+        # bulk_create не везде возвращает первичные ключи (SQLite)
+        categories = list(Category.objects.filter(slug__startswith=prefix))
+        Item.objects.bulk_create(
+            (
+                Item(
+                    title=item_title(rng),
+                    description="Описание товара %s" % number,
+                    price=rng.randint(500, 10000),
+                    discount_price=(
+                        rng.randint(100, 500) if rng.random() < 0.3 else None
+                    ),
+                    category=rng.choice(categories),
+                    label=rng.choice("PSD"),
+                    slug=f"{prefix}-i{number}",
+                    image="item_photos/benchmark.jpg",
+                )
+                for number in range(options["items"])
+            ),
+            batch_size=500,
+        )
+        items = list(Item.objects.filter(slug__startswith=prefix))
+        category = items[0].category
+
+        user = User.objects.create(username=f"bench-{prefix}")
+        for address_type in ("S", "B"):
+            Address.objects.create(
+                user=user,
+                street_address="Тверская улица",
+                apartment_address="1",
+                country="RU",
+                zip="101000",
+                address_type=address_type,
+                default=True,
+            )
+        address = Address.objects.filter(user=user).first()
+        Address.objects.bulk_create(
+            Address(user=user, street_address="улица %s" % number,
+                    apartment_address="1", country="RU", zip="101000",
+                    address_type=rng.choice("SB"))
+            for number in range(options["orders"])
+        )
+
+        for number in range(options["orders"]):
+            payment = Payment.objects.create(
+                stripe_charge_id=f"ch_{prefix}_{number}", user=user,
+                amount=rng.randint(1000, 50000),
+            )
+            self.create_order(
+                rng, user, items, ordered=True, payment=payment,
+                billing_address=address, shipping_address=address,
+                ref_code=f"{prefix}{number}",
+            )
+        Refund.objects.bulk_create(
+            Refund(order=order, reason="Не подошёл размер",
+                   email="bench@example.com")
+            for order in Order.objects.filter(user=user)
+        )
+        cart = [(item, rng.randint(1, 3)) for item in rng.sample(items[1:], 5)]
+        return {
+            "user": user,
+            "admin": User.objects.create(
+                username=f"admin-{prefix}", is_staff=True, is_superuser=True
+            ),
+            "category": category,
+            "product": items[0],
+            "query": items[0].title.split()[0],
+            "cart": cart,
+        }
+
+    def create_order(self, rng, user, items, **fields):
+        """Заказ из нескольких случайных товаров"""
+        OrderItem.objects.bulk_create(
+            OrderItem(user=user, item=item, ordered=fields["ordered"],
+                      quantity=rng.randint(1, 3))
+            for item in rng.sample(items, 5)
+        )
+        order_items = OrderItem.objects.filter(user=user, order__isnull=True)
+        order = Order.objects.create(
+            user=user, ordered_date=timezone.now(), **fields
+        )
+        order.items.add(*order_items)
+        return order
+
+    def report(self, results):
+        self.stdout.write(
+            f"{'страница':<36} {'запросов':>9} {'p50 мс':>9} {'p95 мс':>9}"
+        )
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<36} {result['queries']:>9} "
+                f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f}"
+            )
+
+    def save_baseline(self, path, results):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2,
+                      sort_keys=True)
+            file.write("\n")
+        self.stdout.write(self.style.SUCCESS(f"Базовые результаты: {path}"))
+
+    def compare(self, path, results, tolerance):
+        if not os.path.exists(path):
+            raise CommandError(
+                f"Нет файла {path}, запустите с --update-baseline"
+            )
+        with open(path, encoding="utf-8") as file:
+            baseline = json.load(file)
+
+        regressions = []
+        for name, result in results.items():
+            expected = baseline.get(name)
+            if expected is None:
+                continue
+            if result["queries"] > expected["queries"]:
+                regressions.append(
+                    f"{name}: запросов {result['queries']} > "
+                    f"{expected['queries']}"
+                )
+            # Время сравнивается по медиане: p95 на десятках запросов
+            # слишком зависит от случайных пауз (GC, соседние процессы)
+            limit = expected["p50_ms"] * tolerance
+            if tolerance and result["p50_ms"] > limit:
+                regressions.append(
+                    f"{name}: p50 {result['p50_ms']:.2f} мс > {limit:.2f} мс"
+                )
+        if regressions:
+            raise CommandError("Регрессия:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("Регрессий нет"))
@@ -0,0 +1,79 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+
+from core.cache import bump_catalog_versions, bump_item_versions
+from core.images import generate_derivatives
+from core.models import Item
+
+
+class Command(BaseCommand):
+    """Пакетная генерация уменьшенных копий изображений товаров"""
+
+    help = "Сгенерировать уменьшенные копии изображений товаров"
+
+    chunk_size = 500
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=None,
+            help="Количество процессов (по умолчанию - по числу ядер)",
+        )
+        parser.add_argument(
+            "--force", action="store_true",
+            help="Пересоздать копии даже если они уже есть",
+        )
+
+    def handle(self, *args, **kwargs):
+        items = Item.objects.exclude(image="")
+        if not kwargs["force"]:
+            # Товары без ширины обработаны до появления поля: их копии
+            # могли быть растянуты и названы без расширения оригинала
+            items = items.exclude(
+                image_derivatives=F("image"), image_width__isnull=False
+            )
+        pending = {}
+        for pk, image in items.values_list("pk", "image").iterator():
+            pending.setdefault(image, []).append(pk)
+
+        # Дочерние процессы не должны делить соединения с БД родителя
+        connections.close_all()
+        done, failed = {}, 0
+        with ProcessPoolExecutor(max_workers=kwargs["workers"],
+                                 initializer=django.setup) as executor:
+            futures = {
+                executor.submit(generate_derivatives, image): image
+                for image in pending
+            }
+            for future in as_completed(futures):
+                try:
+                    width = future.result()
+                    done.setdefault(width, []).extend(
+                        pending[futures[future]]
+                    )
+                except (OSError, ValueError) as e:
+                    failed += 1
+                    self.stderr.write(str(e))
+
+        # Копии готовы для текущего изображения товара
+        for width, pks in done.items():
+            for start in range(0, len(pks), self.chunk_size):
+                chunk = pks[start:start + self.chunk_size]
+                Item.objects.filter(pk__in=chunk).update(
+                    image_derivatives=F("image"),
+                    image_width=width,
+                    updated_at=timezone.now(),
+                )
+                bump_item_versions(chunk)
+        if done:
+            # Списки товаров показывают копии изображений
+            bump_catalog_versions()
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Обработано товаров: %s, ошибок: %s"
+                % (sum(map(len, done.values())), failed))
+        )
@@ -0,0 +1,151 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import (CaptureQueriesContext, setup_test_environment,
+                               teardown_test_environment)
+from django.urls import reverse
+
+from core.models import Coupon, Item, Order
+
+# Что можно передать в EXPLAIN (остальное - INSERT, SAVEPOINT и т.п.)
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE")
+
+
+def seq_scans(plan):
+    """Узлы Seq Scan плана PostgreSQL (FORMAT JSON) с вложенными"""
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan
+    for child in plan.get("Plans", ()):
+        yield from seq_scans(child)
+
+
+class Command(BaseCommand):
+    """Проверка планов запросов основных страниц через EXPLAIN.
+
+    Страницы запрашиваются тестовым клиентом от имени существующего
+    пользователя (в транзакции, которая откатывается), все их запросы
+    проходят через EXPLAIN, и последовательное чтение большой таблицы
+    считается ошибкой. Запускать на базе с объёмом данных, близким к
+    боевому (например, после seed_shop), иначе планировщик законно
+    выбирает Seq Scan для маленьких таблиц
+    """
+
+    help = "Найти последовательное чтение больших таблиц в запросах страниц"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-rows", type=int, default=10000,
+            help="Таблица считается большой начиная с этого числа строк",
+        )
+        parser.add_argument(
+            "--analyze", action="store_true",
+            help="Обновить статистику планировщика (ANALYZE) перед проверкой",
+        )
+        parser.add_argument(
+            "--verbose-plans", action="store_true",
+            help="Вывести планы всех запросов",
+        )
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor != "postgresql":
+            raise CommandError("Проверка планов работает только в PostgreSQL")
+        if kwargs["analyze"]:
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+        setup_test_environment()
+        try:
+            with transaction.atomic():
+                queries = self.capture()
+                failures = self.explain(queries, kwargs)
+                transaction.set_rollback(True)
+        finally:
+            teardown_test_environment()
+
+        if failures:
+            raise CommandError(
+                "Последовательное чтение больших таблиц:\n"
+                + "\n".join(failures)
+            )
+        self.stdout.write(self.style.SUCCESS(
+            "Проверено запросов: %s, Seq Scan больших таблиц нет"
+            % len(queries)
+        ))
+
+    def capture(self):
+        """SQL всех запросов основных страниц: {sql: имя страницы}"""
+        order = Order.objects.filter(ordered=True).order_by("-id").first()
+        item = Item.objects.order_by("-id").first()
+        coupon = Coupon.objects.first()
+        if order is None or item is None:
+            raise CommandError(
+                "Нет заказов или товаров, сначала заполните базу (seed_shop)"
+            )
+        client = Client()
+        client.force_login(order.user)
+        client.post(reverse("core:add-to-cart", args=[item.slug]),
+                    {"amount": 1})
+
+        pages = [
+            ("core:home", "get", reverse("core:home"), {}),
+            ("core:category", "get",
+             reverse("core:category", args=[item.category.slug]),
+             {"label": item.label, "price": "100-500", "discounted": "1"}),
+            ("core:search", "get", reverse("core:search"),
+             {"q": item.title.split()[0]}),
+            ("core:product", "get",
+             reverse("core:product", args=[item.slug]), {}),
+            ("core:order-summary", "get", reverse("core:order-summary"), {}),
+            ("core:checkout", "get", reverse("core:checkout"), {}),
+            ("core:profile", "get", reverse("core:profile"), {}),
+            ("core:order-detail", "get",
+             reverse("core:order-detail", args=[order.ref_code]), {}),
+            ("core:add-coupon", "post", reverse("core:add-coupon"),
+             {"code": coupon.code if coupon else "NOCOUPON"}),
+            ("core:request-refund", "post", reverse("core:request-refund"),
+             {"ref_code": order.ref_code, "message": "Проверка",
+              "email": "check@example.com"}),
+            ("core:add-to-cart", "post",
+             reverse("core:add-to-cart", args=[item.slug]), {"amount": 1}),
+            ("core:remove_single_item_from_cart", "get",
+             reverse("core:remove_single_item_from_cart", args=[item.slug]),
+             {}),
+            ("core:remove-from-cart", "get",
+             reverse("core:remove-from-cart", args=[item.slug]), {}),
+        ]
+        queries = {}
+        for name, method, url, params in pages:
+            with CaptureQueriesContext(connection) as captured:
+                getattr(client, method)(url, params)
+            for query in captured:
+                sql = query["sql"]
+                if sql.lstrip().upper().startswith(EXPLAINABLE):
+                    queries.setdefault(sql, name)
+        return queries
+
+    def explain(self, queries, options):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'"
+            )
+            sizes = dict(cursor.fetchall())
+
+            failures = []
+            for sql, page in queries.items():
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                plan = plan[0]["Plan"]
+                if options["verbose_plans"]:
+                    self.stdout.write(f"{page}: {sql}\n{json.dumps(plan)}\n")
+                for node in seq_scans(plan):
+                    table = node["Relation Name"]
+                    if sizes.get(table, 0) >= options["min_rows"]:
+                        failures.append(
+                            f"{page}: {table} (~{sizes[table]:.0f} строк)\n"
+                            f"  {sql}"
+                        )
+        return failures
@@ -0,0 +1,65 @@
+import argparse
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from core.exporting import EXPORT_FORMATS, export_lines, export_rows
+from core.models import Order
+
+
+def parse_date(value):
+    """Дата из аргумента (type= для argparse: ошибка выводится как ошибка
+    использования команды, без трассировки)"""
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "неверная дата %s, нужен формат ГГГГ-ММ-ДД" % value
+        )
+
+
+class Command(BaseCommand):
+    """Выгрузка заказов с позициями, платежами, пользователями, адресами и
+    купонами в CSV или JSONL. Строки пишутся по мере чтения из базы,
+    поэтому память не растёт с объёмом выгрузки"""
+
+    help = "Выгрузить заказы и платежи в CSV или JSONL"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=sorted(EXPORT_FORMATS),
+                            default="csv", help="Формат выгрузки")
+        parser.add_argument("--output", default="-",
+                            help="Файл выгрузки (по умолчанию - stdout)")
+        parser.add_argument("--from", dest="date_from", type=parse_date,
+                            help="Платежи начиная с даты (ГГГГ-ММ-ДД)")
+        parser.add_argument("--to", dest="date_to", type=parse_date,
+                            help="Платежи по дату включительно (ГГГГ-ММ-ДД)")
+        parser.add_argument("--all", action="store_true",
+                            help="Включить неоплаченные заказы")
+        parser.add_argument("--chunk-size", type=int, default=2000,
+                            help="Строк в одной пачке чтения из базы")
+
+    def handle(self, *args, **kwargs):
+        orders = None if kwargs["all"] else Order.objects.filter(ordered=True)
+        rows = export_rows(
+            orders, kwargs["date_from"], kwargs["date_to"],
+            chunk_size=kwargs["chunk_size"],
+        )
+        lines = export_lines(rows, kwargs["format"])
+        if kwargs["output"] == "-":
+            for line in lines:
+                self.stdout.write(line, ending="")
+            return
+
+        count = 0
+        with open(kwargs["output"], "w", encoding="utf-8",
+                  newline="") as file:
+            for line in lines:
+                file.write(line)
+                count += 1
+        if kwargs["format"] == "csv":
+            # Без строки заголовка
+            count -= 1
+        self.stdout.write(self.style.SUCCESS(
+            "Выгружено строк: %s в %s" % (count, kwargs["output"])
+        ))
@@ -0,0 +1,146 @@
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from core.cache import bump_catalog_versions, bump_item_versions
+from core.facets import rebuild_facets
+from core.importing import (CategoryResolver, ImageLoader, ItemSlugResolver,
+                            parse_row, read_rows, upsert_items)
+from core.models import Item
+from core.seeding import chunked
+
+
+class Command(BaseCommand):
+    """Потоковый импорт каталога из CSV или JSONL.
+
+    Файл читается построчно и обрабатывается пачками: категории ищутся и
+    создаются одним запросом на пачку, slug генерируются пачкой, товары
+    вставляются или обновляются (по slug) одним INSERT ... ON CONFLICT.
+    Каждая пачка - отдельная транзакция, поэтому прерванный импорт можно
+    просто запустить заново.
+
+    Поля строки: title, category, price, discount_price, label (P, S, D),
+    description, slug, image (имя файла в каталоге --images). Строка без
+    slug обновляет товар с тем же названием в той же категории, а если его
+    нет - создаёт товар со slug из названия (см. ItemSlugResolver)
+    """
+
+    help = "Импортировать товары из CSV или JSONL файла"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Файл с товарами")
+        parser.add_argument("--format", choices=("csv", "jsonl"),
+                            help="Формат файла (по умолчанию - по расширению)")
+        parser.add_argument("--images",
+                            help="Каталог с изображениями товаров")
+        parser.add_argument("--chunk-size", type=int, default=2000,
+                            help="Строк в одной пачке")
+        parser.add_argument("--max-errors", type=int, default=20,
+                            help="Сколько ошибочных строк вывести")
+        parser.add_argument("--build-derivatives", action="store_true",
+                            help="Сразу сделать уменьшенные копии "
+                                 "изображений (build_image_derivatives)")
+
+    def handle(self, *args, **kwargs):
+        self.options = kwargs
+        self.categories = CategoryResolver()
+        self.slugs = ItemSlugResolver()
+        self.images = ImageLoader(kwargs["images"])
+        self.stats = {"rows": 0, "created": 0, "updated": 0, "errors": 0}
+        started = time.perf_counter()
+
+        try:
+            for chunk in chunked(read_rows(kwargs["path"], kwargs["format"]),
+                                 kwargs["chunk_size"]):
+                self.import_chunk(self.parse(chunk))
+                self.stats["rows"] += len(chunk)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    "Строк: %s, %.0f строк/с"
+                    % (self.stats["rows"], self.stats["rows"] / elapsed),
+                    ending="\r",
+                )
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+        self.stdout.write("")
+
+        # Товары записаны в обход save() и сигналов: счётчики фильтров и
+        # кэш каталога обновляются вручную
+        rebuild_facets()
+        bump_catalog_versions()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            "Импорт за %.1f с (%.0f строк/с): создано %s, обновлено %s, "
+            "новых категорий %s, ошибок %s" % (
+                elapsed, self.stats["rows"] / max(elapsed, 1e-6),
+                self.stats["created"], self.stats["updated"],
+                self.categories.created, self.stats["errors"],
+            )
+        ))
+        if kwargs["build_derivatives"]:
+            call_command("build_image_derivatives")
+
+    def parse(self, chunk):
+        """Разобрать строки пачки, ошибочные - пропустить"""
+        rows = []
+        for line, raw in chunk:
+            try:
+                row = parse_row(raw)
+                row["image"] = self.images.load(row["image"])
+            except (TypeError, ValueError) as e:
+                self.error(line, e)
+                continue
+            row["line"] = line
+            rows.append(row)
+        return rows
+
+    def import_chunk(self, rows):
+        with transaction.atomic():
+            categories = self.categories.resolve(
+                {row["category"] for row in rows}
+            )
+            self.slugs.reserve(row["slug"] for row in rows if row["slug"])
+            generated = [row for row in rows if not row["slug"]]
+            for row, slug in zip(generated, self.slugs.resolve([
+                    (row["title"], categories[row["category"]])
+                    for row in generated])):
+                row["slug"] = slug
+            # Повтор slug в пачке - побеждает последняя строка
+            rows = {row["slug"]: row for row in rows}
+            existing = dict(
+                Item.objects.filter(slug__in=rows).values_list("slug", "pk")
+            )
+
+            items = []
+            now = timezone.now()
+            for slug, row in rows.items():
+                if slug not in existing and not row["image"]:
+                    self.error(row["line"], "у нового товара нет изображения")
+                    continue
+                items.append({
+                    "title": row["title"],
+                    "description": row["description"],
+                    "price": row["price"],
+                    "discount_price": row["discount_price"],
+                    "category_id": categories[row["category"]],
+                    "label": row["label"],
+                    "slug": slug,
+                    "image": row["image"],
+                    "image_derivatives": "",
+                    "updated_at": now,
+                })
+            if items:
+                upsert_items(items)
+        # Обновлённые товары должны пропасть из кэша фрагментов
+        bump_item_versions(existing.values())
+        self.stats["updated"] += len(existing)
+        self.stats["created"] += len(items) - len(existing)
+
+    def error(self, line, message):
+        self.stats["errors"] += 1
+        if self.stats["errors"] <= self.options["max_errors"]:
+            self.stderr.write("Строка %s: %s" % (line, message))
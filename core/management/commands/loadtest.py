@@ -0,0 +1,273 @@
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.metrics import percentile
+
+CATALOG = "catalog"
+CHECKOUT = "checkout"
+# Опрос статуса оплаты - как на странице ожидания (payment_status.html)
+PAYMENT_POLL_INTERVAL = 1.5
+PAYMENT_PENDING = ("pending", "processing")
+PAYMENT_FAILED = ("failed", "review")
+
+
+def redirected_to(prefix):
+    """Проверка ответа: после редиректов открыта страница с путём prefix"""
+    return lambda response: urlsplit(response.url).path.startswith(prefix)
+
+
+def payment_not_failed(response):
+    """Проверка ответа: оплата не отклонена и не ушла на проверку"""
+    return response.json()["status"] not in PAYMENT_FAILED
+
+
+class Target:
+    """Сервер под нагрузкой: адрес, товары и категории каталога"""
+
+    def __init__(self, url, timeout):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.items = []
+        self.categories = []
+
+    def discover(self):
+        """Товары и категории для запросов - из API каталога"""
+        items = requests.get(
+            self.url + "/api/v1/items/",
+            params={"fields": "slug,title", "page_size": 100},
+            timeout=self.timeout,
+        )
+        categories = requests.get(
+            self.url + "/api/v1/categories/",
+            params={"fields": "slug"}, timeout=self.timeout,
+        )
+        items.raise_for_status()
+        categories.raise_for_status()
+        self.items = items.json()["results"]
+        self.categories = [row["slug"] for row in categories.json()]
+        if not self.items or not self.categories:
+            raise CommandError("В каталоге %s нет товаров" % self.url)
+
+
+class VirtualUser(threading.Thread):
+    """Посетитель со своей сессией: листает каталог или кладёт товары в
+    корзину, оформляет заказ и оплачивает его. Ответы не из 2xx/3xx -
+    ошибки, как и ответы, не прошедшие проверку expect"""
+
+    def __init__(self, target, kind, deadline, results, login=None,
+                 token=None):
+        super().__init__(daemon=True)
+        self.target = target
+        self.kind = kind
+        self.deadline = deadline
+        self.results = results
+        self.login = login
+        self.token = token
+        self.session = requests.Session()
+
+    def request(self, method, path, expect=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.target.url + path,
+                timeout=self.target.timeout, **kwargs
+            )
+            ok = response.status_code < 400 and (
+                expect is None or expect(response)
+            )
+        except (requests.RequestException, ValueError):
+            response, ok = None, False
+        self.results.append(
+            (self.kind, time.perf_counter() - start, ok)
+        )
+        return response
+
+    def csrf_post(self, path, data, expect=None):
+        data["csrfmiddlewaretoken"] = self.session.cookies.get(
+            settings.CSRF_COOKIE_NAME, ""
+        )
+        return self.request("post", path, expect=expect, data=data,
+                            headers={"Referer": self.target.url + path})
+
+    def browse(self):
+        item = random.choice(self.target.items)
+        path = random.choice((
+            "/",
+            "/category/%s/" % random.choice(self.target.categories),
+            "/products/%s/" % item["slug"],
+            "/search/?q=%s" % item["title"].split()[0],
+            "/api/v1/items/?page_size=20",
+        ))
+        self.request("get", path)
+
+    def checkout(self):
+        slug = random.choice(self.target.items)["slug"]
+        self.request("get", "/products/%s/" % slug)
+        self.csrf_post("/add-to-cart/%s/" % slug, {"amount": 1})
+        self.request("get", "/order-summary/")
+        if self.login:
+            self.place_order()
+        self.request("get", "/remove-from-cart/%s/" % slug)
+
+    def place_order(self):
+        """Оформить заказ с адресами по умолчанию, оплатить картой и
+        дождаться результата оплаты от воркера process_payments"""
+        self.request("get", "/checkout/")
+        # Без адресов по умолчанию оформление возвращает на /checkout/
+        expect = redirected_to("/payment/stripe/")
+        response = self.csrf_post("/checkout/", {
+            "use_default_shipping": "on",
+            "use_default_billing": "on",
+            "payment_option": "S",
+        }, expect=expect)
+        if response is None or not expect(response):
+            return
+        expect = redirected_to("/payment-status/")
+        response = self.csrf_post(
+            "/payment/stripe/", {"stripeToken": self.token}, expect=expect
+        )
+        if response is None or not expect(response):
+            return
+        path = urlsplit(response.url).path
+        status = PAYMENT_PENDING[0]
+        while status in PAYMENT_PENDING and time.monotonic() < self.deadline:
+            time.sleep(PAYMENT_POLL_INTERVAL)
+            response = self.request("get", path, params={"format": "json"},
+                                    expect=payment_not_failed)
+            try:
+                status = response.json()["status"]
+            except (AttributeError, KeyError, ValueError):
+                return
+
+    def run(self):
+        if self.login:
+            self.request("get", "/accounts/login/")
+            username, password = self.login
+            self.csrf_post("/accounts/login/", {
+                "login": username, "password": password,
+            })
+        step = self.checkout if self.kind == CHECKOUT else self.browse
+        while time.monotonic() < self.deadline:
+            step()
+
+
+class Command(BaseCommand):
+    """Нагрузочный тест работающих серверов смешанным трафиком.
+
+    Часть виртуальных посетителей листает каталог (главная, категории,
+    товары, поиск, API), остальные кладут товары в корзину, а с --login
+    оформляют заказ, оплачивают его и ждут результата оплаты. Серверы
+    из --url нагружаются по очереди одинаковым
+    трафиком, результаты выводятся рядом - например, для сравнения
+    настроек gunicorn на одной копии приложения
+    """
+
+    help = "Сравнить пропускную способность серверов под смешанной нагрузкой"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url", action="append", required=True,
+            help="Адрес сервера (можно указать несколько раз)",
+        )
+        parser.add_argument(
+            "--duration", type=float, default=30,
+            help="Сколько секунд нагружать каждый сервер",
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=20,
+            help="Количество одновременных посетителей",
+        )
+        parser.add_argument(
+            "--checkout-share", type=float, default=0.2,
+            help="Доля посетителей, оформляющих заказ",
+        )
+        parser.add_argument(
+            "--login",
+            help="Пользователь для оформления заказа (логин:пароль) с "
+                 "адресами по умолчанию, без него корзина проверяется "
+                 "анонимно",
+        )
+        parser.add_argument(
+            "--stripe-token", default="tok_visa",
+            help="Токен карты для оплаты (тестовые ключи Stripe или "
+                 "заглушка в STRIPE_API_BASE)",
+        )
+        parser.add_argument(
+            "--timeout", type=float, default=10,
+            help="Таймаут одного запроса, в секундах",
+        )
+
+    def handle(self, *args, **kwargs):
+        login = None
+        if kwargs["login"]:
+            login = tuple(kwargs["login"].split(":", 1))
+            if len(login) != 2:
+                raise CommandError("--login задаётся как логин:пароль")
+        checkout_users = round(
+            kwargs["concurrency"] * kwargs["checkout_share"]
+        )
+
+        reports = []
+        for url in kwargs["url"]:
+            target = Target(url, kwargs["timeout"])
+            try:
+                target.discover()
+            except (requests.RequestException, ValueError, KeyError) as e:
+                raise CommandError("%s: %s" % (url, e))
+            self.stdout.write("Нагрузка на %s..." % target.url)
+            reports.append((target.url, self.run(
+                target, kwargs["concurrency"], checkout_users,
+                kwargs["duration"], login, kwargs["stripe_token"],
+            )))
+        self.report(reports)
+
+    def run(self, target, concurrency, checkout_users, duration, login,
+            token):
+        results = []
+        started = time.monotonic()
+        deadline = started + duration
+        users = [
+            VirtualUser(
+                target, CHECKOUT if index < checkout_users else CATALOG,
+                deadline, results,
+                login=login if index < checkout_users else None,
+                token=token,
+            )
+            for index in range(concurrency)
+        ]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        return results, time.monotonic() - started
+
+    def report(self, reports):
+        self.stdout.write(
+            f"{'Сервер':<32}{'Трафик':<10}{'Запросов':>10}{'RPS':>9}"
+            f"{'Ошибок':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}"
+        )
+        for url, (results, elapsed) in reports:
+            by_kind = defaultdict(list)
+            for kind, latency, ok in results:
+                by_kind[kind].append((latency, ok))
+                by_kind["total"].append((latency, ok))
+            for kind in (CATALOG, CHECKOUT, "total"):
+                samples = by_kind.get(kind)
+                if not samples:
+                    continue
+                latencies = [latency * 1000 for latency, _ in samples]
+                self.stdout.write(
+                    f"{url:<32}{kind:<10}{len(samples):>10}"
+                    f"{len(samples) / elapsed:>9.1f}"
+                    f"{sum(not ok for _, ok in samples):>8}"
+                    f"{percentile(latencies, 50):>10.1f}"
+                    f"{percentile(latencies, 95):>10.1f}"
+                    f"{percentile(latencies, 99):>10.1f}"
+                )
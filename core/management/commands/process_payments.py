@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.metrics import measure, registry
+from core.payments import claim_tasks, process_task
+
+
+class Command(BaseCommand):
+    """Воркер очереди оплат: списывает деньги через Stripe вне запросов"""
+
+    help = "Обработать очередь оплат Stripe"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch", type=int, default=10,
+            help="Сколько задач забирать за один раз",
+        )
+        parser.add_argument(
+            "--interval", type=float, default=1.0,
+            help="Пауза в секундах, если очередь пуста",
+        )
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Обработать текущую очередь и завершиться",
+        )
+
+    def handle(self, *args, **kwargs):
+        processed = 0
+        try:
+            while True:
+                tasks = claim_tasks(kwargs["batch"])
+                for task in tasks:
+                    with measure() as sample:
+                        process_task(task)
+                    registry.observe("task:process_payment", sample)
+                processed += len(tasks)
+                if not tasks:
+                    if kwargs["once"]:
+                        break
+                    time.sleep(kwargs["interval"])
+        except KeyboardInterrupt:
+            pass
+        registry.flush()
+
+        self.stdout.write(
+            self.style.SUCCESS("Обработано задач оплаты: %s" % processed)
+        )
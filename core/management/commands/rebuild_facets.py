@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core.facets import rebuild_facets
+
+
+class Command(BaseCommand):
+    """Пересчёт счётчиков фильтров категорий. Нужен после изменения
+    товаров в обход save() (bulk_create, update, импорт каталога)"""
+
+    help = "Пересчитать счётчики фасетов категорий"
+
+    def handle(self, *args, **kwargs):
+        count = rebuild_facets()
+        self.stdout.write(
+            self.style.SUCCESS("Пересчитано фасетов: %s" % count)
+        )
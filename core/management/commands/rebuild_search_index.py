@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from core.search import get_search_backend
+
+
+class Command(BaseCommand):
+    """Пересоздать поисковый индекс товаров"""
+
+    help = "Пересоздать поисковый индекс товаров"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database", default=DEFAULT_DB_ALIAS,
+            help="Подключение к БД, для которого перестраивается индекс",
+        )
+
+    def handle(self, *args, **kwargs):
+        backend = get_search_backend(kwargs["database"])
+        backend.setup()
+        backend.rebuild()
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Поисковый индекс перестроен (%s)" % type(backend).__name__)
+        )
@@ -0,0 +1,317 @@
+import random
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from PIL import Image, ImageDraw
+
+from core.cache import bump_catalog_versions
+from core.facets import rebuild_facets
+from core.images import derivative_name, generate_derivatives
+from core.models import (Address, Category, Coupon, Item, Order, OrderItem,
+                         Payment, UserProfile)
+from core.seeding import CATEGORIES, BulkWriter, explicit_dates, item_title
+
+User = get_user_model()
+
+PLACEHOLDER_SIZE = (800, 1200)
+PLACEHOLDER_COLORS = ((231, 76, 60), (52, 152, 219), (46, 204, 113),
+                      (241, 196, 15), (155, 89, 182), (52, 73, 94),
+                      (230, 126, 34), (26, 188, 156))
+
+
+# Момент, от которого отсчитываются даты заказов, если --now не задан:
+# с текущим временем данные менялись бы от запуска к запуску
+SEED_NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def parse_now(value):
+    """Дата и время из --now в формате ISO 8601"""
+    moment = parse_datetime(value)
+    if moment is None:
+        raise ValueError(value)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, timezone.utc)
+    return moment
+
+
+class Command(BaseCommand):
+    """Генерация большого каталога и истории заказов для профилирования.
+
+    Данные воспроизводимы при одинаковых --seed, --now и --first-id: даты
+    отсчитываются от --now, а id всех строк - от --first-id, а не от уже
+    записанных в базе строк. Строки вставляются пачками
+    (COPY в PostgreSQL, bulk_create в остальных базах), без save() и
+    сигналов post_save, поэтому профили пользователей создаются здесь же
+    """
+
+    help = "Заполнить магазин синтетическими товарами и заказами"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--categories", type=int, default=50,
+                            help="Количество категорий")
+        parser.add_argument("--items", type=int, default=100000,
+                            help="Количество товаров")
+        parser.add_argument("--users", type=int, default=10000,
+                            help="Количество пользователей")
+        parser.add_argument("--orders", type=int, default=1000000,
+                            help="Количество оплаченных заказов")
+        parser.add_argument("--max-lines", type=int, default=5,
+                            help="Максимум позиций в заказе")
+        parser.add_argument("--seed", type=int, default=42,
+                            help="Зерно генератора случайных чисел")
+        parser.add_argument("--now", type=parse_now, default=SEED_NOW,
+                            help="Момент, от которого отсчитываются даты "
+                                 "заказов (ISO 8601)")
+        parser.add_argument("--first-id", type=int, default=1,
+                            help="Первый id вставляемых строк")
+        parser.add_argument("--chunk-size", type=int, default=10000,
+                            help="Строк в одной пачке вставки")
+        parser.add_argument("--no-copy", action="store_true",
+                            help="Не использовать COPY в PostgreSQL")
+
+    def handle(self, *args, **kwargs):
+        self.rng = random.Random(kwargs["seed"])
+        self.now = kwargs["now"]
+        # Строки вставляются с заранее известными id, чтобы не перечитывать
+        # их для внешних ключей
+        self.first_id = kwargs["first_id"]
+        self.check_free_ids()
+        self.writer = BulkWriter(kwargs["chunk_size"],
+                                 use_copy=not kwargs["no_copy"])
+        started = time.perf_counter()
+
+        images = self.create_placeholders()
+        with transaction.atomic(), explicit_dates(
+            Category._meta.get_field("updated_at"),
+            Item._meta.get_field("updated_at"),
+            Order._meta.get_field("start_date"),
+            Payment._meta.get_field("timestamp"),
+        ):
+            categories = self.create_categories(kwargs["categories"])
+            items = self.create_items(kwargs["items"], categories, images)
+            users, addresses = self.create_users(kwargs["users"])
+            coupons = self.create_coupons()
+            self.create_orders(kwargs, items, users, addresses, coupons)
+            self.writer.reset_sequences()
+            # Сигналы не отправлялись, поэтому счётчики фильтров и кэш
+            # каталога обновляются вручную
+            rebuild_facets()
+        bump_catalog_versions()
+
+        for model, (rows, seconds) in self.writer.stats.items():
+            self.stdout.write(
+                f"{str(model._meta.verbose_name_plural):<30} {rows:>10} строк "
+                f"{seconds:>8.1f} с {rows / max(seconds, 1e-6):>10.0f} строк/с"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            "Магазин заполнен за %.1f с" % (time.perf_counter() - started)
+        ))
+
+    def check_free_ids(self):
+        """Id вставляемых строк не должны пересекаться с уже записанными"""
+        for model in (Category, Item, User, UserProfile, Address, Coupon,
+                      Order, OrderItem, Payment):
+            if model.objects.filter(pk__gte=self.first_id).exists():
+                raise CommandError(
+                    "В таблице %s уже есть строки с id от %s, укажите "
+                    "--first-id больше" % (model._meta.db_table, self.first_id)
+                )
+
+    def create_placeholders(self):
+        """Несколько изображений-заглушек с готовыми уменьшенными копиями"""
+        names = []
+        for number, color in enumerate(PLACEHOLDER_COLORS):
+            name = f"item_photos/placeholders/placeholder-{number}.jpg"
+            if not default_storage.exists(name):
+                image = Image.new("RGB", PLACEHOLDER_SIZE, color)
+                ImageDraw.Draw(image).rectangle(
+                    (200, 300, 600, 900), outline=(255, 255, 255), width=12
+                )
+                buffer = BytesIO()
+                image.save(buffer, "JPEG", quality=80)
+                default_storage.save(name, ContentFile(buffer.getvalue()))
+            # Копии пересоздаются и для старых заглушек, если имена копий
+            # поменялись
+            thumb = derivative_name(name, "thumb", "jpg")
+            if not default_storage.exists(thumb):
+                generate_derivatives(name)
+            names.append(name)
+        return names
+
+    def create_categories(self, count):
+        ids = range(self.first_id, self.first_id + count)
+        self.writer.write(Category, (
+            Category(
+                id=pk,
+                name="%s %s" % (self.rng.choice(CATEGORIES), pk),
+                slug=f"category-{pk}",
+                updated_at=self.now,
+            )
+            for pk in ids
+        ))
+        return ids
+
+    def create_items(self, count, categories, images):
+        ids = range(self.first_id, self.first_id + count)
+        rng = self.rng
+        # Цена со скидкой по id товара - для сумм платежей в заказах
+        self.prices = {}
+
+        def items():
+            for pk in ids:
+                price = rng.randint(300, 20000)
+                discount_price = (
+                    round(price * rng.uniform(0.5, 0.9))
+                    if rng.random() < 0.3 else None
+                )
+                self.prices[pk] = discount_price or price
+                image = rng.choice(images)
+                yield Item(
+                    id=pk,
+                    title=item_title(rng),
+                    description="Описание товара %s" % pk,
+                    price=price,
+                    discount_price=discount_price,
+                    category_id=rng.choice(categories),
+                    label=rng.choice("PSD"),
+                    slug=f"item-{pk}",
+                    image=image,
+                    image_derivatives=image,
+                    image_width=PLACEHOLDER_SIZE[0],
+                    updated_at=self.now,
+                )
+
+        self.writer.write(Item, items())
+        return ids
+
+    def create_users(self, count):
+        """Пользователи с профилями и адресами доставки и оплаты"""
+        ids = range(self.first_id, self.first_id + count)
+        # Один непригодный для входа пароль на всех: хэширование для
+        # каждого пользователя заняло бы больше времени, чем вся вставка.
+        # make_password(None) добавил бы к нему случайную строку
+        password = UNUSABLE_PASSWORD_PREFIX + "seed"
+        self.writer.write(User, (
+            User(
+                id=pk,
+                username=f"user{pk}",
+                email=f"user{pk}@example.com",
+                password=password,
+                date_joined=self.now,
+            )
+            for pk in ids
+        ))
+        self.writer.write(UserProfile, (
+            UserProfile(id=pk, user_id=pk) for pk in ids
+        ))
+
+        addresses = {}
+
+        def user_addresses():
+            pk = self.first_id
+            for user_id in ids:
+                for address_type in ("S", "B"):
+                    addresses[user_id, address_type] = pk
+                    yield Address(
+                        id=pk,
+                        user_id=user_id,
+                        street_address="улица %s" % self.rng.randint(1, 500),
+                        apartment_address=str(self.rng.randint(1, 300)),
+                        country="RU",
+                        zip="%06d" % self.rng.randint(100000, 999999),
+                        address_type=address_type,
+                        default=True,
+                    )
+                    pk += 1
+
+        self.writer.write(Address, user_addresses())
+        return ids, addresses
+
+    def create_coupons(self):
+        ids = range(self.first_id, self.first_id + 20)
+        # Скидка по id купона - для сумм платежей в заказах
+        self.coupons = {pk: self.rng.randint(1, 20) for pk in ids}
+        self.writer.write(Coupon, (
+            Coupon(id=pk, code=f"SALE{pk}", amount=amount)
+            for pk, amount in self.coupons.items()
+        ))
+        return ids
+
+    def create_orders(self, options, items, users, addresses, coupons):
+        """Оплаченные заказы с позициями, платежами и связями M2M.
+        Генерируются пачками, чтобы не держать миллионы объектов в памяти"""
+        rng = self.rng
+        total = options["orders"]
+        chunk = options["chunk_size"]
+        order_id = payment_id = line_id = self.first_id
+        through = Order.items.through
+
+        for offset in range(0, total, chunk):
+            payments, orders, lines, links = [], [], [], []
+            for _ in range(min(chunk, total - offset)):
+                user_id = rng.choice(users)
+                ordered_date = self.now - timedelta(
+                    seconds=rng.randint(0, 2 * 365 * 24 * 60 * 60)
+                )
+                amount = 0
+                for item_id in rng.sample(items, rng.randint(
+                        1, options["max_lines"])):
+                    quantity = rng.randint(1, 3)
+                    amount += quantity * self.prices[item_id]
+                    lines.append(OrderItem(
+                        id=line_id, user_id=user_id, item_id=item_id,
+                        quantity=quantity, ordered=True,
+                    ))
+                    links.append(through(
+                        order_id=order_id, orderitem_id=line_id
+                    ))
+                    line_id += 1
+                coupon_id = (
+                    rng.choice(coupons) if rng.random() < 0.1 else None
+                )
+                if coupon_id is not None:
+                    # Оплачивается сумма со скидкой по купону, как в
+                    # Order.with_totals
+                    amount -= self.coupons[coupon_id]
+                payments.append(Payment(
+                    id=payment_id, user_id=user_id, amount=amount,
+                    stripe_charge_id=f"ch_seed_{payment_id}",
+                    timestamp=ordered_date,
+                ))
+                delivered = ordered_date < self.now - timedelta(days=7)
+                orders.append(Order(
+                    id=order_id,
+                    user_id=user_id,
+                    ref_code=f"seed{order_id}",
+                    start_date=ordered_date - timedelta(
+                        minutes=rng.randint(1, 600)
+                    ),
+                    ordered_date=ordered_date,
+                    ordered=True,
+                    billing_address_id=addresses[user_id, "B"],
+                    shipping_address_id=addresses[user_id, "S"],
+                    payment_id=payment_id,
+                    coupon_id=coupon_id,
+                    being_delivered=delivered,
+                    received=delivered,
+                ))
+                order_id += 1
+                payment_id += 1
+
+            self.writer.write(Payment, payments)
+            self.writer.write(Order, orders)
+            self.writer.write(OrderItem, lines)
+            self.writer.write(through, links)
+            self.stdout.write(
+                f"Заказы: {offset + len(orders)}/{total}", ending="\r"
+            )
+        self.stdout.write("")
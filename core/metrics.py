@@ -0,0 +1,231 @@
+import contextvars
+import logging
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы времени ответа, в секундах
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Список представлений, по которым есть счётчики в кэше
+VIEWS_KEY = "metrics:views"
+
+# Замеры текущего запроса: через них клиент Stripe отдаёт своё время
+_current_sample = contextvars.ContextVar("metrics_sample", default=None)
+
+
+class Sample:
+    """Замеры одного запроса: время, SQL-запросы и обращения к Stripe"""
+
+    def __init__(self):
+        self.latency = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.stripe_calls = 0
+        self.stripe_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        """Обёртка выполнения SQL (connection.execute_wrapper)"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+@contextmanager
+def measure():
+    """Замерить блок кода: время, запросы ко всем БД и время в Stripe"""
+    sample = Sample()
+    token = _current_sample.set(sample)
+    start = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(sample))
+            yield sample
+    finally:
+        sample.latency = time.perf_counter() - start
+        _current_sample.reset(token)
+
+
+class StripeClientTimer:
+    """HTTP-клиент Stripe, который учитывает время запросов к API"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def request_with_retries(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._client.request_with_retries(*args, **kwargs)
+        finally:
+            sample = _current_sample.get()
+            if sample is not None:
+                sample.stripe_calls += 1
+                sample.stripe_time += time.perf_counter() - start
+
+
+def percentile(values, percent):
+    """Процентиль методом ближайшего ранга"""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def check_budget(view, sample):
+    """Список превышений бюджета представления (PERFORMANCE_BUDGETS)"""
+    budgets = settings.PERFORMANCE_BUDGETS
+    budget = budgets.get(view, budgets.get("default", {}))
+    actual = {
+        "queries": sample.queries,
+        "latency_ms": sample.latency * 1000,
+        "db_ms": sample.db_time * 1000,
+        "stripe_ms": sample.stripe_time * 1000,
+    }
+    return [
+        "%s=%.0f > %s" % (name, actual[name], limit)
+        for name, limit in budget.items()
+        if actual[name] > limit
+    ]
+
+
+class Registry:
+    """Счётчики по представлениям.
+
+    Замеры копятся в памяти процесса и раз в METRICS_FLUSH_INTERVAL секунд
+    сбрасываются в общий кэш, поэтому эндпоинт метрик отдаёт сумму по всем
+    воркерам gunicorn и воркеру оплат. Время хранится в микросекундах,
+    чтобы счётчики можно было увеличивать через cache.incr
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(Counter)
+        self._flushed_at = time.monotonic()
+
+    def observe(self, view, sample):
+        violations = check_budget(view, sample)
+        if violations:
+            logger.warning(
+                "Превышен бюджет %s: %s", view, ", ".join(violations)
+            )
+        with self._lock:
+            counters = self._pending[view]
+            counters["requests"] += 1
+            counters["latency_us"] += int(sample.latency * 1e6)
+            counters["queries"] += sample.queries
+            counters["db_time_us"] += int(sample.db_time * 1e6)
+            counters["stripe_calls"] += sample.stripe_calls
+            counters["stripe_time_us"] += int(sample.stripe_time * 1e6)
+            counters["budget_violations"] += bool(violations)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if sample.latency <= bound:
+                    counters["bucket_%s" % index] += 1
+            due = (
+                time.monotonic() - self._flushed_at
+                >= settings.METRICS_FLUSH_INTERVAL
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(Counter)
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return
+        # Метрики не должны ронять запросы, если кэш недоступен
+        try:
+            views = cache.get(VIEWS_KEY) or set()
+            if not views.issuperset(pending):
+                cache.set(VIEWS_KEY, views | set(pending), None)
+            for view, counters in pending.items():
+                for field, value in counters.items():
+                    key = "metrics:%s:%s" % (view, field)
+                    cache.add(key, 0, None)
+                    cache.incr(key, value)
+        except Exception:
+            logger.exception("Не удалось сохранить метрики в кэш")
+
+    def snapshot(self):
+        """Накопленные счётчики: {представление: {поле: значение}}"""
+        self.flush()
+        views = sorted(cache.get(VIEWS_KEY) or ())
+        fields = [
+            "requests", "latency_us", "queries", "db_time_us",
+            "stripe_calls", "stripe_time_us", "budget_violations",
+        ] + ["bucket_%s" % index for index in range(len(LATENCY_BUCKETS))]
+        keys = {
+            (view, field): "metrics:%s:%s" % (view, field)
+            for view in views
+            for field in fields
+        }
+        values = cache.get_many(keys.values())
+        result = {view: {} for view in views}
+        for (view, field), key in keys.items():
+            result[view][field] = values.get(key, 0)
+        return result
+
+
+registry = Registry()
+
+
+# Имя метрики, тип, описание и поле счётчика (с делителем для секунд)
+PROMETHEUS_COUNTERS = (
+    ("django_view_requests_total", "Количество запросов",
+     "requests", 1),
+    ("django_view_db_queries_total", "Количество SQL-запросов",
+     "queries", 1),
+    ("django_view_db_time_seconds_total", "Время выполнения SQL-запросов",
+     "db_time_us", 1e6),
+    ("django_view_stripe_calls_total", "Количество запросов к Stripe",
+     "stripe_calls", 1),
+    ("django_view_stripe_time_seconds_total", "Время запросов к Stripe",
+     "stripe_time_us", 1e6),
+    ("django_view_budget_violations_total", "Количество превышений бюджета",
+     "budget_violations", 1),
+)
+
+
+def render_prometheus():
+    """Счётчики в текстовом формате Prometheus"""
+    snapshot = registry.snapshot()
+    lines = []
+    for name, description, field, divisor in PROMETHEUS_COUNTERS:
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s counter" % name)
+        for view, counters in snapshot.items():
+            value = counters[field]
+            if divisor != 1:
+                value /= divisor
+            lines.append('%s{view="%s"} %s' % (name, view, value))
+
+    name = "django_view_latency_seconds"
+    lines.append("# HELP %s Время ответа" % name)
+    lines.append("# TYPE %s histogram" % name)
+    for view, counters in snapshot.items():
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            lines.append('%s_bucket{view="%s",le="%s"} %s' % (
+                name, view, bound, counters["bucket_%s" % index]
+            ))
+        lines.append('%s_bucket{view="%s",le="+Inf"} %s' % (
+            name, view, counters["requests"]
+        ))
+        lines.append('%s_sum{view="%s"} %s' % (
+            name, view, counters["latency_us"] / 1e6
+        ))
+        lines.append('%s_count{view="%s"} %s' % (
+            name, view, counters["requests"]
+        ))
+    return "\n".join(lines) + "\n"
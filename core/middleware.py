@@ -0,0 +1,64 @@
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .metrics import measure, registry
+from .routers import (PIN_COOKIE, RoutingState, reset_state, set_state,
+                      use_primary)
+
+
+class MetricsMiddleware:
+    """Замеры времени ответа, SQL-запросов и Stripe по представлениям.
+
+    Должен стоять первым в MIDDLEWARE, чтобы учитывать время остальных
+    middleware. Счётчики отдаются эндпоинтом core:metrics
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with measure() as sample:
+            response = self.get_response(request)
+        match = request.resolver_match
+        registry.observe(match.view_name if match else "unresolved", sample)
+        return response
+
+
+class ReplicaMiddleware:
+    """Выбор базы для чтения каталога (см. core.routers.ReplicaRouter).
+
+    Безопасные запросы без куки PIN_COOKIE читают каталог со случайной
+    реплики. Изменяющие запросы и посетители, недавно что-то записавшие,
+    читают с основной базы. Стоит после SessionMiddleware, поэтому
+    сохранение сессии записью не считается
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        replicas = settings.DATABASE_REPLICAS
+        pinned = (
+            not replicas
+            or request.method not in ("GET", "HEAD", "OPTIONS")
+            or PIN_COOKIE in request.COOKIES
+        )
+        state = RoutingState(None if pinned else random.choice(replicas))
+        token = set_state(state)
+        try:
+            with connections[DEFAULT_DB_ALIAS].execute_wrapper(state):
+                response = self.get_response(request)
+        finally:
+            reset_state(token)
+        if state.wrote and replicas:
+            response.set_cookie(
+                PIN_COOKIE, "1", max_age=settings.REPLICA_LAG,
+                httponly=True, samesite="Lax",
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.view_name in settings.PRIMARY_DB_VIEWS:
+            use_primary()
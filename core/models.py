@@ -1,10 +1,17 @@
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import (Count, ExpressionWrapper, F, FloatField,
+                              Prefetch, Sum, Value)
+from django.db.models.functions import Coalesce
 from django.db.models.signals import post_save
 from django.urls import reverse
+from django.utils import timezone
 from django_countries.fields import CountryField
 
+from .images import derivative_url, srcset
+
 User = get_user_model()
 
 LABEL_CHOICES = {
@@ -24,6 +31,7 @@ class Category(models.Model):
 
     name = models.CharField("Название", max_length=50, null=False)
     slug = models.SlugField("slug", unique=True, null=False)
+    updated_at = models.DateTimeField("Изменена", auto_now=True)
 
     def __str__(self):
         return self.name
@@ -37,6 +45,14 @@ class Category(models.Model):
         ordering = ("name",)
 
 
+class ItemManager(models.Manager):
+    """Товары без поискового вектора: он нужен только в условиях поиска,
+    а в каждой выборке списка, API и админки был бы лишними байтами"""
+
+    def get_queryset(self):
+        return super().get_queryset().defer("search_vector")
+
+
 class Item(models.Model):
     """Модель товаров"""
 
@@ -67,6 +83,22 @@ class Item(models.Model):
     image = models.ImageField(
         "Изображение", blank=False, null=False, upload_to="item_photos/"
     )
+    # Поисковый вектор (PostgreSQL). Заполняется триггером, см. core.search
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Имя изображения, для которого сгенерированы уменьшенные копии
+    # (см. core.images). Если не совпадает с image - копии устарели
+    image_derivatives = models.CharField(
+        "Копии изображения", max_length=100, blank=True, editable=False
+    )
+    # Ширина оригинала: копии не шире него, srcset строится по ней
+    image_width = models.PositiveIntegerField(
+        "Ширина изображения", null=True, editable=False
+    )
+    # Для Last-Modified страницы товара. Массовые изменения в обход save()
+    # (update, импорт) должны заполнять его сами
+    updated_at = models.DateTimeField("Изменён", auto_now=True)
+
+    objects = ItemManager()
 
     def __str__(self):
         return self.title
@@ -83,10 +115,87 @@ class Item(models.Model):
         """Метод для удаления товара из корзины заказа"""
         return reverse("core:remove-from-cart", kwargs={"slug": self.slug})
 
+    @property
+    def has_image_derivatives(self):
+        """Готовы ли уменьшенные копии текущего изображения"""
+        return (
+            bool(self.image)
+            and self.image_derivatives == self.image.name
+            and self.image_width is not None
+        )
+
+    def get_image_url(self, size="card", ext="jpg"):
+        """Ссылка на копию изображения нужного размера (или на оригинал)"""
+        if self.has_image_derivatives:
+            return derivative_url(self.image.name, size, ext)
+        return self.image.url
+
+    def get_image_srcset(self, ext="jpg"):
+        """srcset из копий изображения всех размеров"""
+        if self.has_image_derivatives:
+            return srcset(self.image.name, ext, self.image_width)
+        return ""
+
     class Meta:
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
         ordering = ("id",)
+        # Фильтры списка товаров категории (см. core.facets)
+        indexes = [
+            models.Index(fields=["category", "label", "id"],
+                         name="item_category_label_idx"),
+            models.Index(fields=["category", "price"],
+                         name="item_category_price_idx"),
+            models.Index(fields=["category", "discount_price"],
+                         name="item_category_discount_idx"),
+        ]
+
+
+class CategoryFacet(models.Model):
+    """Количество товаров категории для значения фильтра (фасета).
+    Поддерживается сигналами при изменении товаров, см. core.facets"""
+
+    category = models.ForeignKey(
+        Category,
+        on_delete=models.CASCADE,
+        related_name="facets",
+        verbose_name="Категория",
+    )
+    # Например label:P, price:100-500, discounted
+    facet = models.CharField("Фасет", max_length=30)
+    count = models.IntegerField("Количество товаров", default=0)
+
+    def __str__(self):
+        return f"{self.category_id} {self.facet} - {self.count}"
+
+    class Meta:
+        verbose_name = "Фасет категории"
+        verbose_name_plural = "Фасеты категорий"
+        constraints = [
+            models.UniqueConstraint(fields=["category", "facet"],
+                                    name="unique_category_facet"),
+        ]
+
+
+class OrderItemQuerySet(models.QuerySet):
+    """Запросы к элементам заказа"""
+
+    def with_totals(self):
+        """Посчитать суммы по строке заказа на стороне БД"""
+        final_item_price = Coalesce("item__discount_price", "item__price")
+        return self.annotate(
+            total_item_price=ExpressionWrapper(
+                F("quantity") * F("item__price"), output_field=FloatField()
+            ),
+            final_price=ExpressionWrapper(
+                F("quantity") * final_item_price, output_field=FloatField()
+            ),
+        ).annotate(
+            amount_saved=ExpressionWrapper(
+                F("total_item_price") - F("final_price"),
+                output_field=FloatField(),
+            )
+        )
 
 
 class OrderItem(models.Model):
@@ -108,6 +217,8 @@ class OrderItem(models.Model):
         validators=[MinValueValidator(1, "Минимальное количество- 1")],
     )
 
+    objects = OrderItemQuerySet.as_manager()
+
     def __str__(self):
         return f"Предмет: {self.item.title} | Кол-во: {self.quantity}"
 
@@ -134,6 +245,59 @@ class OrderItem(models.Model):
     class Meta:
         verbose_name = "Товар в заказе"
         verbose_name_plural = "Товары в заказах"
+        constraints = [
+            # Один товар - одна строка в корзине пользователя
+            models.UniqueConstraint(
+                fields=["user", "item"],
+                condition=models.Q(ordered=False),
+                name="unique_cart_item",
+            ),
+        ]
+
+
+class OrderQuerySet(models.QuerySet):
+    """Запросы к корзинам"""
+
+    def with_totals(self):
+        """Посчитать итоги корзины одним SQL запросом.
+
+        total_item_price - сумма без скидок, amount_saved - экономия за счёт
+        скидок, coupon_amount - скидка по купону, total_sum - итог к оплате.
+        """
+        total_item_price = ExpressionWrapper(
+            F("items__quantity") * F("items__item__price"),
+            output_field=FloatField(),
+        )
+        final_price = ExpressionWrapper(
+            F("items__quantity")
+            * Coalesce("items__item__discount_price", "items__item__price"),
+            output_field=FloatField(),
+        )
+        zero = Value(0.0, output_field=FloatField())
+        return self.annotate(
+            items_count=Count("items"),
+            total_item_price=Coalesce(Sum(total_item_price), zero),
+            final_price=Coalesce(Sum(final_price), zero),
+            coupon_amount=Coalesce("coupon__amount", zero),
+        ).annotate(
+            amount_saved=ExpressionWrapper(
+                F("total_item_price") - F("final_price"),
+                output_field=FloatField(),
+            ),
+            total_sum=ExpressionWrapper(
+                F("final_price") - F("coupon_amount"),
+                output_field=FloatField(),
+            ),
+        )
+
+    def with_items(self):
+        """Подгрузить товары корзины вместе с суммами по строкам"""
+        items = OrderItem.objects.select_related("item").defer(
+            "item__search_vector"
+        ).with_totals()
+        return self.select_related("coupon").prefetch_related(
+            Prefetch("items", queryset=items)
+        )
 
 
 class Order(models.Model):
@@ -191,22 +355,58 @@ class Order(models.Model):
     )
     refund_granted = models.BooleanField("Возврат оформлен", default=False)
 
+    objects = OrderQuerySet.as_manager()
+
     def __str__(self):
         return f"Корзина - {self.user.username} | ref_code - {self.ref_code}"
 
+    @property
+    def lines(self):
+        """Строки заказа (в шаблонах так же называются строки корзины)"""
+        return self.items.all()
+
     def get_total_sum(self):
-        """Итоговая сумма заказа в корзине"""
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        # Если есть купон
-        if self.coupon:
-            total -= self.coupon.amount
-        return total
+        """Итоговая сумма заказа в корзине (с учётом купона)"""
+        # Если заказ получен через with_totals, то сумма уже посчитана в БД
+        if hasattr(self, "total_sum"):
+            return self.total_sum
+        return (
+            Order.objects.with_totals()
+            .values_list("total_sum", flat=True)
+            .get(pk=self.pk)
+        )
 
     class Meta:
         verbose_name = "Корзина"
         verbose_name_plural = "Корзины"
+        constraints = [
+            # У пользователя одна активная (неоплаченная) корзина
+            models.UniqueConstraint(
+                fields=["user"],
+                condition=models.Q(ordered=False),
+                name="unique_open_order",
+            ),
+        ]
+        indexes = [
+            # Заказы пользователя (профиль, корзина, оплата)
+            models.Index(fields=["user", "ordered"],
+                         name="order_user_ordered_idx"),
+            # Поиск заказа по коду (детали заказа, возврат)
+            models.Index(fields=["ref_code"], name="order_ref_code_idx"),
+        ]
+
+
+class AddressQuerySet(models.QuerySet):
+    """Запросы к адресам"""
+
+    def defaults(self, user):
+        """Адреса пользователя по умолчанию одним запросом: {тип: адрес}.
+        Если по умолчанию отмечено несколько адресов одного типа, берётся
+        последний добавленный"""
+        addresses = {}
+        for address in self.filter(user=user, default=True).order_by("-id"):
+            addresses.setdefault(address.address_type, address)
+        return addresses
 
 
 class Address(models.Model):
@@ -230,6 +430,8 @@ class Address(models.Model):
     # Поле типа адреса по умолчанию
     default = models.BooleanField("Адрес по умолчанию", default=False)
 
+    objects = AddressQuerySet.as_manager()
+
     def __str__(self):
         return f"Адрес {self.street_address} пользователя {self.user.username}"
 
@@ -237,6 +439,12 @@ class Address(models.Model):
         verbose_name = "Адреса доставки"
         verbose_name_plural = "Адресы доставок"
         ordering = ("-id",)
+        indexes = [
+            # Адреса по умолчанию при оформлении заказа
+            models.Index(fields=["user", "address_type"],
+                         condition=models.Q(default=True),
+                         name="address_default_idx"),
+        ]
 
 
 class Payment(models.Model):
@@ -267,6 +475,66 @@ class Payment(models.Model):
         verbose_name = "Платёж"
         verbose_name_plural = "Платежи"
         ordering = ("-id",)
+        indexes = [
+            # Выгрузка и фильтр заказов по дате платежа
+            models.Index(fields=["timestamp"], name="payment_timestamp_idx"),
+        ]
+
+
+class PaymentTask(models.Model):
+    """Задача на списание средств через Stripe (выполняется воркером
+    process_payments, а не в запросе пользователя)"""
+
+    PENDING = "pending"
+    PROCESSING = "processing"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    # Stripe так и не ответил: списание могло пройти, нужна сверка
+    REVIEW = "review"
+    STATUS_CHOICES = (
+        (PENDING, "В очереди"),
+        (PROCESSING, "Обрабатывается"),
+        (SUCCEEDED, "Оплачен"),
+        (FAILED, "Ошибка"),
+        (REVIEW, "Требует проверки"),
+    )
+    # Списание ещё не завершено: строки и сумму заказа менять нельзя, а
+    # новая попытка оплаты с новым ключом могла бы списать деньги дважды
+    IN_PROGRESS = (PENDING, PROCESSING, REVIEW)
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, verbose_name="Пользователь"
+    )
+    order = models.ForeignKey(
+        Order,
+        on_delete=models.CASCADE,
+        related_name="payment_tasks",
+        verbose_name="Заказ",
+    )
+    token = models.CharField("Токен Stripe", max_length=255)
+    amount = models.PositiveIntegerField("Сумма в центах")
+    # Ключ идемпотентности Stripe: повтор задачи не спишет деньги дважды
+    idempotency_key = models.CharField(
+        "Ключ идемпотентности", max_length=64, unique=True
+    )
+    status = models.CharField(
+        "Статус", max_length=10, choices=STATUS_CHOICES, default=PENDING
+    )
+    attempts = models.PositiveSmallIntegerField("Попыток", default=0)
+    # Воркер не берёт задачу раньше этого времени (пауза между повторами)
+    run_after = models.DateTimeField("Не раньше", default=timezone.now)
+    error = models.CharField("Ошибка", max_length=255, blank=True)
+    created_at = models.DateTimeField("Создана", auto_now_add=True)
+    updated_at = models.DateTimeField("Изменена", auto_now=True)
+
+    def __str__(self):
+        return f"{self.idempotency_key} | {self.get_status_display()}"
+
+    class Meta:
+        verbose_name = "Задача оплаты"
+        verbose_name_plural = "Задачи оплаты"
+        ordering = ("id",)
+        indexes = [models.Index(fields=["status", "id"])]
 
 
 class Coupon(models.Model):
@@ -286,6 +554,7 @@ class Coupon(models.Model):
         verbose_name = "Купон"
         verbose_name_plural = "Купоны"
         ordering = ("amount",)
+        indexes = [models.Index(fields=["code"], name="coupon_code_idx")]
 
 
 class Refund(models.Model):
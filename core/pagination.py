@@ -0,0 +1,208 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+NEXT = "n"
+PREVIOUS = "p"
+
+
+def encode_cursor(values, direction):
+    """Упаковать значения ключа сортировки в непрозрачную строку"""
+    data = json.dumps([direction, values], cls=DjangoJSONEncoder)
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Распаковать курсор. Возвращает (значения, направление)"""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, values = json.loads(data.decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise Http404("Неверный курсор")
+    if direction not in (NEXT, PREVIOUS) or not isinstance(values, list):
+        raise Http404("Неверный курсор")
+    return values, direction
+
+
+def estimate_count(queryset):
+    """Оценка количества строк по плану запроса PostgreSQL (без COUNT(*)).
+    Для остальных СУБД возвращает None"""
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class KeysetPage:
+    """Страница выборки по курсору"""
+
+    def __init__(self, object_list, paginator, next_cursor=None,
+                 previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f"<KeysetPage ({len(self.object_list)} objects)>"
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """Постраничный вывод по ключу сортировки (seek-метод).
+
+    Вместо OFFSET страница выбирается условием "после последней строки
+    предыдущей страницы" по ключу ordering, а вместо COUNT(*) берётся на
+    одну строку больше, чтобы понять, есть ли следующая страница. Поэтому
+    любая страница стоит столько же, сколько первая. Последнее поле ordering
+    должно быть уникальным (обычно id).
+    """
+
+    def __init__(self, queryset, per_page, ordering=("id",),
+                 estimate_total=False):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = [
+            (field.lstrip("-"), field.startswith("-")) for field in ordering
+        ]
+        self.estimate_total = estimate_total
+
+    @cached_property
+    def estimated_total(self):
+        """Примерное количество объектов (если включено)"""
+        if not self.estimate_total:
+            return None
+        return estimate_count(self.queryset)
+
+    def order_by(self, reverse=False):
+        return [
+            f"{'-' if descending != reverse else ''}{name}"
+            for name, descending in self.ordering
+        ]
+
+    def seek(self, values, reverse=False):
+        """Условие "строго после values" в порядке сортировки:
+        (a > x) OR (a = x AND b > y) OR ..."""
+        condition = Q()
+        for index, (name, descending) in enumerate(self.ordering):
+            lookup = "lt" if descending != reverse else "gt"
+            step = Q(**{f"{name}__{lookup}": values[index]})
+            for prev_index in range(index):
+                step &= Q(**{self.ordering[prev_index][0]: values[prev_index]})
+            condition |= step
+        return condition
+
+    def clean_values(self, values):
+        """Привести значения из курсора к типам полей сортировки. Курсор
+        приходит от клиента, поэтому неверные значения - 404, а не 500"""
+        if len(values) != len(self.ordering):
+            raise Http404("Неверный курсор")
+        annotations = self.queryset.query.annotations
+        cleaned = []
+        for value, (name, _) in zip(values, self.ordering):
+            if name in annotations:
+                field = annotations[name].output_field
+            else:
+                field = self.queryset.model._meta.get_field(name)
+            try:
+                value = field.to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                raise Http404("Неверный курсор")
+            # Поля сортировки не пустые, с None условие seek не строится
+            if value is None:
+                raise Http404("Неверный курсор")
+            cleaned.append(value)
+        return cleaned
+
+    def key(self, obj):
+        return [getattr(obj, name) for name, _ in self.ordering]
+
+    def page(self, cursor=None):
+        """Страница после/до курсора (без курсора - первая страница)"""
+        values, direction = None, NEXT
+        if cursor:
+            values, direction = decode_cursor(cursor)
+
+        # Пустой queryset (none()) может не иметь полей сортировки,
+        # например rank пустого поиска - в базу идти незачем
+        if self.queryset.query.is_empty():
+            return KeysetPage([], self)
+        if values is not None:
+            values = self.clean_values(values)
+
+        reverse = direction == PREVIOUS
+        queryset = self.queryset.order_by(*self.order_by(reverse))
+        if values is not None:
+            queryset = queryset.filter(self.seek(values, reverse))
+        object_list = list(queryset[: self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[: self.per_page]
+
+        if reverse:
+            object_list.reverse()
+            has_previous, has_next = has_more, True
+        else:
+            has_previous, has_next = values is not None, has_more
+
+        if not object_list:
+            return KeysetPage(object_list, self)
+        return KeysetPage(
+            object_list,
+            self,
+            next_cursor=(
+                encode_cursor(self.key(object_list[-1]), NEXT)
+                if has_next else None
+            ),
+            previous_cursor=(
+                encode_cursor(self.key(object_list[0]), PREVIOUS)
+                if has_previous else None
+            ),
+        )
+
+
+class KeysetPaginationMixin:
+    """Пагинация ListView по курсору (?cursor=...) вместо номера страницы"""
+
+    keyset_ordering = ("id",)
+    estimate_total = True
+    cursor_kwarg = "cursor"
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(
+            queryset,
+            page_size,
+            ordering=self.keyset_ordering,
+            estimate_total=self.estimate_total,
+        )
+        page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        return paginator, page, page.object_list, page.has_other_pages()
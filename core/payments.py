@@ -0,0 +1,235 @@
+import logging
+import random
+import string
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .cart import mark_order_paid
+from .metrics import StripeClientTimer
+from .models import Order, OrderItem, Payment, PaymentTask
+
+logger = logging.getLogger(__name__)
+
+# Настройка работы с банковскими картами
+stripe.api_key = settings.STRIPE_SECRET_KEY
+stripe.api_base = settings.STRIPE_API_BASE
+# Время запросов к Stripe попадает в метрики (core.metrics)
+stripe.default_http_client = StripeClientTimer(
+    stripe.http_client.new_default_http_client(
+        verify_ssl_certs=stripe.verify_ssl_certs, proxy=stripe.proxy
+    )
+)
+
+# Сколько раз повторять задачу при временных ошибках Stripe
+MAX_ATTEMPTS = 5
+# Пауза перед повтором растёт вдвое с каждой попыткой: 5, 10, 20, 40 с
+RETRY_DELAY = timedelta(seconds=5)
+# Задача "в обработке" дольше этого времени считается брошенной воркером
+STALE_AFTER = timedelta(minutes=5)
+
+# https://stripe.com/docs/api/errors/handling?lang=python
+ERROR_MESSAGES = (
+    # Too many requests made to the API too quickly
+    (stripe.error.RateLimitError, "Rate limit error"),
+    # Invalid parameters were supplied to Stripe's API
+    (stripe.error.InvalidRequestError, "Invalid parameters"),
+    # Authentication with Stripe's API failed
+    # (maybe you changed API keys recently)
+    (stripe.error.AuthenticationError, "Not authenticated"),
+    # Network communication with Stripe failed
+    (stripe.error.APIConnectionError, "Network error"),
+    (
+        stripe.error.StripeError,
+        "Something went wrong. You were not charged. Please try again.",
+    ),
+)
+# Ошибки, после которых задачу можно повторить с тем же ключом
+RETRYABLE_ERRORS = (stripe.error.RateLimitError,
+                    stripe.error.APIConnectionError)
+
+
+def create_ref_code():
+    """Создания реферального кода (Для поиска заказа)"""
+    return "".join(
+        random.choices(string.ascii_lowercase + string.digits, k=20))
+
+
+def enqueue_charge(order, user, token):
+    """Поставить списание за заказ в очередь.
+    Если по заказу уже есть незавершённая задача - вернуть её, если
+    платить нечего (купон больше суммы заказа) - None.
+
+    Ключ идемпотентности - заказ и номер попытки оплаты, а не случайный:
+    параллельные запросы (двойной клик) получают один и тот же ключ, и
+    вторую задачу не даст создать уникальный индекс. Новая попытка после
+    ошибки получает новый ключ, иначе Stripe вернул бы прошлую ошибку
+    """
+    with transaction.atomic():
+        # Строка заказа заблокирована до постановки задачи: повторное
+        # оформление корзины (place_order) не заменит строки заказа
+        # между подсчётом суммы и появлением задачи
+        Order.objects.select_for_update().filter(pk=order.pk).exists()
+        tasks = order.payment_tasks.all()
+        task = tasks.filter(status__in=PaymentTask.IN_PROGRESS).first()
+        if task is not None:
+            return task
+        total = Order.objects.with_totals().values_list(
+            "total_sum", flat=True
+        ).get(pk=order.pk)
+        # Цена идет в центах, по этому нужно умножить на 100
+        amount = int(round(total * 100))
+        if amount <= 0:
+            return None
+        # Дата создания заказа отличает заказы с одинаковым id после
+        # пересоздания базы: ключи Stripe общие для всего аккаунта
+        key = "order-%s-%s-%s" % (
+            order.pk, int(order.start_date.timestamp()), tasks.count() + 1
+        )
+        try:
+            with transaction.atomic():
+                task = PaymentTask.objects.create(
+                    user=user,
+                    order=order,
+                    token=token,
+                    amount=amount,
+                    idempotency_key=key,
+                )
+        except IntegrityError:
+            # Задачу с этим ключом уже поставил параллельный запрос.
+            # Другие нарушения ограничений - ошибка, а не гонка
+            task = PaymentTask.objects.filter(idempotency_key=key).first()
+            if task is None:
+                raise
+    return task
+
+
+def claim_tasks(limit):
+    """Забрать задачи в обработку. SKIP LOCKED позволяет запускать
+    несколько воркеров без двойной обработки"""
+    now = timezone.now()
+    with transaction.atomic():
+        tasks = list(
+            PaymentTask.objects.select_related("order", "user")
+            .select_for_update(skip_locked=True, of=("self",))
+            .filter(
+                Q(status=PaymentTask.PENDING, run_after__lte=now)
+                | Q(status=PaymentTask.PROCESSING,
+                    updated_at__lt=now - STALE_AFTER)
+            )
+            .order_by("id")[:limit]
+        )
+        PaymentTask.objects.filter(pk__in=[task.pk for task in tasks]).update(
+            status=PaymentTask.PROCESSING,
+            attempts=F("attempts") + 1,
+            updated_at=now,
+        )
+    for task in tasks:
+        task.attempts += 1
+    return tasks
+
+
+def process_task(task):
+    """Списать деньги по задаче и оформить заказ"""
+    try:
+        charge = stripe.Charge.create(
+            amount=task.amount,
+            currency="usd",  # cents
+            source=task.token,
+            idempotency_key=task.idempotency_key,
+        )
+    except stripe.error.CardError as e:
+        body = e.json_body or {}
+        fail_task(task, body.get("error", {}).get("message") or str(e))
+    except RETRYABLE_ERRORS as e:
+        if task.attempts < MAX_ATTEMPTS:
+            logger.warning("Повтор оплаты %s: %s", task.idempotency_key, e)
+            retry_task(task)
+        elif isinstance(e, stripe.error.APIConnectionError):
+            # Запрос мог дойти до Stripe, и деньги могли списаться. Новая
+            # попытка пользователя получила бы новый ключ идемпотентности,
+            # поэтому задача ждёт сверки с Stripe в админке
+            logger.error("Оплата %s требует проверки: %s",
+                         task.idempotency_key, e)
+            PaymentTask.objects.filter(pk=task.pk).update(
+                status=PaymentTask.REVIEW, error=error_message(e)
+            )
+        else:
+            fail_task(task, error_message(e))
+    except stripe.error.StripeError as e:
+        fail_task(task, error_message(e))
+    except Exception:
+        logger.exception("Ошибка оплаты %s", task.idempotency_key)
+        fail_task(task, "A serious error occurred. We have been notifed.")
+    else:
+        try:
+            finalize_order(task, charge["id"])
+        except Exception:
+            # Деньги уже списаны. Задача остаётся "в обработке" и после
+            # STALE_AFTER снова попадёт к воркеру: списание с тем же
+            # ключом идемпотентности вернёт тот же платёж Stripe
+            logger.exception(
+                "Ошибка оформления оплаченного заказа %s",
+                task.idempotency_key,
+            )
+
+
+def error_message(error):
+    for error_class, message in ERROR_MESSAGES:
+        if isinstance(error, error_class):
+            return message
+    return str(error)
+
+
+def retry_task(task):
+    """Вернуть задачу в очередь с паузой, растущей с каждой попыткой"""
+    delay = RETRY_DELAY * 2 ** (task.attempts - 1)
+    PaymentTask.objects.filter(pk=task.pk).update(
+        status=PaymentTask.PENDING, run_after=timezone.now() + delay
+    )
+
+
+def fail_task(task, message):
+    PaymentTask.objects.filter(pk=task.pk).update(
+        status=PaymentTask.FAILED, error=message[:255]
+    )
+
+
+def finalize_order(task, charge_id):
+    """Оформить оплаченный заказ: создать платёж, отметить товары и заказ.
+
+    Всё выполняется в одной транзакции фиксированным числом запросов,
+    которое не зависит от количества товаров в корзине. Заказ оформляется
+    один раз: задачу, которую воркер забрал повторно (после STALE_AFTER),
+    второй платёж и новый ссылочный код не создают.
+    """
+    with transaction.atomic():
+        finalized = Order.objects.filter(
+            pk=task.order_id, ordered=False
+        ).update(ordered=True, ref_code=create_ref_code())
+        if finalized:
+            # Создание платежа Django
+            payment = Payment.objects.create(
+                stripe_charge_id=charge_id,
+                user_id=task.user_id,
+                amount=task.amount / 100,
+            )
+            # Прикрепление платежа к заказу
+            Order.objects.filter(pk=task.order_id).update(payment=payment)
+            # Отметить товары заказа как заказанные. После этого следующее
+            # оформление корзины создаст уже новый заказ
+            OrderItem.objects.filter(order=task.order_id).update(
+                ordered=True
+            )
+            # Корзина уберёт оплаченные строки при следующем чтении
+            transaction.on_commit(lambda: mark_order_paid(task.order_id))
+        else:
+            logger.warning("Заказ задачи %s уже оформлен, платёж %s",
+                           task.idempotency_key, charge_id)
+        PaymentTask.objects.filter(
+            pk=task.pk, status=PaymentTask.PROCESSING
+        ).update(status=PaymentTask.SUCCEEDED)
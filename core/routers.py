@@ -0,0 +1,82 @@
+import contextvars
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Кука "читать с основной базы": ставится после записи на REPLICA_LAG
+# секунд, чтобы посетитель видел свои изменения (read-your-writes)
+PIN_COOKIE = "db_primary"
+# Начала изменяющих SQL-запросов
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE")
+
+# Состояние текущего запроса (ставит ReplicaMiddleware). Вне запросов
+# (команды, воркер оплат) его нет, и всё читается с основной базы
+_request_state = contextvars.ContextVar("db_routing", default=None)
+
+
+class RoutingState:
+    """Реплика, выбранная для запроса (None - основная база), и была ли
+    в запросе запись"""
+
+    def __init__(self, replica=None):
+        self.replica = replica
+        self.wrote = False
+
+    def __call__(self, execute, sql, params, many, context):
+        """Обёртка SQL основной базы (connection.execute_wrapper): запись
+        видна по самим запросам. db_for_write для этого не подходит,
+        Django вызывает его и без записи - при связывании объектов"""
+        if sql.lstrip()[:6].upper() in WRITE_STATEMENTS:
+            self.wrote = True
+        return execute(sql, params, many, context)
+
+
+def get_state():
+    return _request_state.get()
+
+
+def set_state(state):
+    return _request_state.set(state)
+
+
+def reset_state(token):
+    _request_state.reset(token)
+
+
+def use_primary():
+    """Читать с основной базы до конца текущего запроса"""
+    state = get_state()
+    if state is not None:
+        state.replica = None
+
+
+class ReplicaRouter:
+    """Чтение каталога (REPLICA_MODELS) - с реплики, остальное - с
+    основной базы.
+
+    Реплика одна на весь запрос, чтобы страница не смешивала данные
+    реплик с разным отставанием. После первой записи, внутри транзакции
+    и в представлениях корзины и оформления заказа (PRIMARY_DB_VIEWS)
+    запрос читает с основной базы
+    """
+
+    def db_for_read(self, model, **hints):
+        state = get_state()
+        if (state is None or state.replica is None or state.wrote
+                or model._meta.label_lower not in settings.REPLICA_MODELS
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            # Явно, иначе связанные объекты читались бы с базы объекта,
+            # загруженного с реплики
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # На репликах те же данные, что и в основной базе
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схема реплик приходит репликацией с основной базы
+        return db not in settings.DATABASE_REPLICAS
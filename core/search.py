@@ -0,0 +1,197 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connections
+from django.db.models import DecimalField, F, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+
+# Конфигурация полнотекстового поиска PostgreSQL (совпадает с LANGUAGE_CODE)
+SEARCH_CONFIG = "russian"
+
+# Вес названия в ранжировании выше, чем у описания
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+# ts_rank считается в float4 и после курсора (JSON, float8) не равен сам
+# себе, поэтому строки с одинаковым rank терялись бы на границе страниц.
+# Числа с фиксированной точностью сравниваются точно
+RANK_FIELD = DecimalField(max_digits=12, decimal_places=6)
+
+# Окончания для упрощённого стемминга запросов в SQLite (FTS5 не умеет
+# русскую морфологию, поэтому ищем по основе слова как по префиксу)
+RUSSIAN_ENDINGS = sorted(
+    (
+        "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "иям", "иях",
+        "ах", "ях", "ов", "ев", "ей", "ой", "ый", "ий", "ая", "яя", "ое",
+        "ее", "ые", "ие", "ом", "ем", "ам", "ям", "ую", "юю", "а", "я", "о",
+        "е", "ы", "и", "у", "ю", "ь",
+    ),
+    key=len,
+    reverse=True,
+)
+
+
+def stem(word):
+    """Отбросить окончание русского слова"""
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[: -len(ending)]
+    return word
+
+
+class BaseSearchBackend:
+    """Поиск товаров. Результаты аннотированы полем rank (чем больше, тем
+    релевантнее) и отсортированы по ("-rank", "id")."""
+
+    def __init__(self, using="default"):
+        self.using = using
+
+    def setup(self):
+        """Создать индексы и триггеры, которые поддерживают поиск"""
+
+    def rebuild(self):
+        """Перестроить поисковый индекс по всем товарам"""
+
+    def search(self, queryset, query):
+        raise NotImplementedError
+
+    def execute(self, *statements):
+        with connections[self.using].cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """Поиск подстрокой для СУБД без полнотекстового поиска"""
+
+    def search(self, queryset, query):
+        return (
+            queryset.filter(
+                Q(title__icontains=query) | Q(description__icontains=query)
+            )
+            .annotate(rank=Value(0.0, output_field=FloatField()))
+            .order_by("-rank", "id")
+        )
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """tsvector колонка core_item.search_vector с GIN индексом.
+    Вектор пересчитывает триггер, поэтому bulk_create и update() тоже
+    попадают в индекс."""
+
+    vector_sql = (
+        "setweight(to_tsvector('{config}', coalesce({table}.title, '')), 'A')"
+        " || setweight(to_tsvector('{config}', "
+        "coalesce({table}.description, '')), 'B')"
+    )
+
+    def setup(self):
+        vector = self.vector_sql.format(config=SEARCH_CONFIG, table="NEW")
+        self.execute(
+            "CREATE OR REPLACE FUNCTION core_item_search_vector_update() "
+            "RETURNS trigger AS $$ BEGIN "
+            f"NEW.search_vector := {vector}; RETURN NEW; "
+            "END $$ LANGUAGE plpgsql",
+            "DROP TRIGGER IF EXISTS core_item_search_vector_trigger "
+            "ON core_item",
+            "CREATE TRIGGER core_item_search_vector_trigger "
+            "BEFORE INSERT OR UPDATE OF title, description ON core_item "
+            "FOR EACH ROW EXECUTE PROCEDURE core_item_search_vector_update()",
+            "CREATE INDEX IF NOT EXISTS core_item_search_vector_gin "
+            "ON core_item USING gin (search_vector)",
+        )
+
+    def rebuild(self):
+        vector = self.vector_sql.format(config=SEARCH_CONFIG,
+                                        table="core_item")
+        self.execute(f"UPDATE core_item SET search_vector = {vector}")
+
+    def search(self, queryset, query):
+        search_query = SearchQuery(query, config=SEARCH_CONFIG)
+        return (
+            queryset.filter(search_vector=search_query)
+            .annotate(rank=Cast(SearchRank(F("search_vector"), search_query),
+                                RANK_FIELD))
+            .order_by("-rank", "id")
+        )
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    """FTS5 таблица core_item_fts поверх core_item (external content),
+    синхронизируется триггерами. Ранжирование - bm25 с весами колонок."""
+
+    def setup(self):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'core_item_fts'"
+            )
+            created = cursor.fetchone() is None
+        self.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS core_item_fts USING fts5("
+            "title, description, content='core_item', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')",
+            "CREATE TRIGGER IF NOT EXISTS core_item_fts_insert "
+            "AFTER INSERT ON core_item BEGIN "
+            "INSERT INTO core_item_fts(rowid, title, description) "
+            "VALUES (new.id, new.title, new.description); END",
+            "CREATE TRIGGER IF NOT EXISTS core_item_fts_delete "
+            "AFTER DELETE ON core_item BEGIN "
+            "INSERT INTO core_item_fts(core_item_fts, rowid, title, "
+            "description) VALUES ('delete', old.id, old.title, "
+            "old.description); END",
+            "CREATE TRIGGER IF NOT EXISTS core_item_fts_update "
+            "AFTER UPDATE OF title, description ON core_item BEGIN "
+            "INSERT INTO core_item_fts(core_item_fts, rowid, title, "
+            "description) VALUES ('delete', old.id, old.title, "
+            "old.description); "
+            "INSERT INTO core_item_fts(rowid, title, description) "
+            "VALUES (new.id, new.title, new.description); END",
+        )
+        if created:
+            self.rebuild()
+        # Столбец rank таблицы FTS5 считает bm25 с весами колонок
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO core_item_fts(core_item_fts, rank) "
+                "VALUES ('rank', %s)",
+                [f"bm25({TITLE_WEIGHT}, {DESCRIPTION_WEIGHT})"],
+            )
+
+    def rebuild(self):
+        self.execute(
+            "INSERT INTO core_item_fts(core_item_fts) VALUES ('rebuild')"
+        )
+
+    def search(self, queryset, query):
+        words = re.findall(r"\w+", query.lower())
+        if not words:
+            return queryset.none()
+        match = " ".join(f'"{stem(word)}"*' for word in words)
+        return (
+            queryset.extra(
+                tables=["core_item_fts"],
+                where=[
+                    "core_item_fts.rowid = core_item.id",
+                    "core_item_fts MATCH %s",
+                ],
+                params=[match],
+            )
+            .annotate(
+                rank=RawSQL("-core_item_fts.rank", (),
+                            output_field=FloatField())
+            )
+            .order_by("-rank", "id")
+        )
+
+
+BACKENDS = {
+    "postgresql": PostgresSearchBackend,
+    "sqlite": SqliteSearchBackend,
+}
+
+
+def get_search_backend(using="default"):
+    """Поисковый бэкенд для СУБД указанного подключения"""
+    vendor = connections[using].vendor
+    return BACKENDS.get(vendor, SimpleSearchBackend)(using)
@@ -0,0 +1,46 @@
+from rest_framework import serializers
+
+from .models import Category, Item
+
+
+class SparseFieldsMixin:
+    """Только запрошенные поля: ?fields=id,title,price. Неизвестные имена
+    игнорируются, без параметра отдаются все поля"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        fields = request.query_params.get("fields") if request else None
+        if fields:
+            requested = set(fields.split(","))
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+
+class CategorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    # Категории берутся из кэша навигации уже с количеством товаров
+    items_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Category
+        fields = ("id", "name", "slug", "items_count")
+
+
+class ItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    category = serializers.SlugRelatedField(slug_field="slug",
+                                            read_only=True)
+    url = serializers.CharField(source="get_absolute_url", read_only=True)
+    image = serializers.SerializerMethodField()
+    thumbnail = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Item
+        fields = ("id", "slug", "title", "description", "price",
+                  "discount_price", "label", "category", "url", "image",
+                  "thumbnail")
+
+    def get_image(self, obj):
+        return obj.get_image_url("detail") if obj.image else None
+
+    def get_thumbnail(self, obj):
+        return obj.get_image_url("card") if obj.image else None
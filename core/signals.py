@@ -0,0 +1,122 @@
+import logging
+
+from django.contrib.auth.signals import user_logged_in
+from django.db import router
+from django.db.models.signals import (post_delete, post_migrate, post_save,
+                                      pre_save)
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import (CATALOG_VERSION_KEY, CATEGORIES_VERSION_KEY,
+                    CATEGORY_ITEMS_VERSION_KEY, CATEGORY_VERSION_KEY,
+                    ITEM_VERSION_KEY, bump_versions)
+from .cart import merge_anonymous_cart
+from .facets import item_facets, stored_facets, update_facets
+from .images import generate_derivatives
+from .models import Category, Item
+from .search import get_search_backend
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    """Сбросить кэш навигации и фрагменты товаров категории (в них её
+    название и ссылка)"""
+    bump_versions([
+        CATALOG_VERSION_KEY, CATEGORIES_VERSION_KEY,
+        CATEGORY_VERSION_KEY % instance.pk,
+    ])
+
+
+def item_version_keys(instance, category_ids):
+    """Версии фрагментов товара и списков, в которых он есть"""
+    return [ITEM_VERSION_KEY % instance.pk, CATALOG_VERSION_KEY] + [
+        CATEGORY_ITEMS_VERSION_KEY % pk for pk in category_ids
+    ]
+
+
+@receiver(post_save, sender=Item)
+def item_changed(sender, instance, **kwargs):
+    """Сбросить кэш фрагментов товара и списков старой и новой категории.
+    Навигация (количество товаров) меняется только при добавлении товара
+    и переносе в другую категорию"""
+    old_category_ids = {pk for pk, _ in instance._old_facets}
+    keys = item_version_keys(
+        instance, old_category_ids | {instance.category_id}
+    )
+    if old_category_ids != {instance.category_id}:
+        keys.append(CATEGORIES_VERSION_KEY)
+    bump_versions(keys)
+
+
+@receiver(post_delete, sender=Item)
+def item_deleted(sender, instance, **kwargs):
+    bump_versions(
+        item_version_keys(instance, [instance.category_id])
+        + [CATEGORIES_VERSION_KEY]
+    )
+
+
+def current_facets(item):
+    return item_facets(
+        item.category_id, item.label, item.price, item.discount_price
+    )
+
+
+@receiver(pre_save, sender=Item)
+def remember_facets(sender, instance, **kwargs):
+    """Запомнить фасеты товара до изменения (для пересчёта счётчиков)"""
+    instance._old_facets = (
+        stored_facets(instance.pk) if instance.pk else set()
+    )
+
+
+@receiver(post_save, sender=Item)
+def item_facets_changed(sender, instance, **kwargs):
+    """Обновить счётчики фасетов категорий на разницу после сохранения"""
+    update_facets(instance._old_facets, current_facets(instance))
+
+
+@receiver(post_delete, sender=Item)
+def item_facets_deleted(sender, instance, **kwargs):
+    update_facets(current_facets(instance), set())
+
+
+@receiver(post_migrate)
+def setup_search(sender, using, **kwargs):
+    """Создать поисковый индекс и триггеры после миграций приложения
+    (кроме реплик: туда они приходят репликацией)"""
+    if sender.name == "core" and router.allow_migrate_model(using, Item):
+        get_search_backend(using).setup()
+
+
+@receiver(post_save, sender=Item)
+def build_image_derivatives(sender, instance, **kwargs):
+    """Сделать уменьшенные копии нового изображения товара"""
+    if not instance.image or instance.has_image_derivatives:
+        return
+    try:
+        width = generate_derivatives(instance.image.name)
+    except (OSError, ValueError):
+        logger.exception("Не удалось обработать %s", instance.image.name)
+        return
+    instance.image_derivatives = instance.image.name
+    instance.image_width = width
+    instance.updated_at = timezone.now()
+    Item.objects.filter(pk=instance.pk).update(
+        image_derivatives=instance.image.name,
+        image_width=width,
+        updated_at=instance.updated_at,
+    )
+    # update() не отправляет сигналы, а фрагменты и списки товаров
+    # содержат адреса копий
+    bump_versions(item_version_keys(instance, [instance.category_id]))
+
+
+@receiver(user_logged_in)
+def merge_cart(sender, request, user, **kwargs):
+    """Перенести товары, добавленные до входа, в корзину пользователя"""
+    if request is not None:
+        merge_anonymous_cart(request, user)
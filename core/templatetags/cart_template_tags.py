@@ -1,15 +1,11 @@
 from django import template
 
-from core.models import Order
+from core.cart import get_cart
 
 register = template.Library()
 
 
 @register.filter
-def cart_item_count(user):
-    """Отобразить количество товаров в корзине пользователя"""
-    if user.is_authenticated:
-        qs = Order.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
-    return 0
+def cart_item_count(request):
+    """Отобразить количество товаров в корзине посетителя"""
+    return get_cart(request).count()
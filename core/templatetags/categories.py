@@ -1,11 +1,11 @@
 from django import template
 
-from core.models import Category
+from core.cache import get_categories as get_cached_categories
 
 register = template.Library()
 
 
 @register.simple_tag()
 def get_categories():
-    """Вывод всех категорий"""
-    return Category.objects.all()
+    """Вывод всех категорий (из кэша)"""
+    return get_cached_categories()
@@ -0,0 +1,14 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from core.cache import render_item_fragments
+
+register = template.Library()
+
+
+@register.simple_tag()
+def item_cards(items):
+    """Карточки товаров списка (HTML из кэша, одним запросом)"""
+    return mark_safe("".join(
+        render_item_fragments(("item_card.html", item) for item in items)
+    ))
@@ -0,0 +1,17 @@
+from django import template
+
+register = template.Library()
+
+
+@register.inclusion_tag("item_picture.html")
+def item_picture(item, size="card", css_class="", sizes="100vw", **attrs):
+    """Картинка товара: WebP со srcset и JPEG как запасной вариант"""
+    return {
+        "item": item,
+        "src": item.get_image_url(size, "jpg"),
+        "webp_srcset": item.get_image_srcset("webp"),
+        "jpg_srcset": item.get_image_srcset("jpg"),
+        "css_class": css_class,
+        "sizes": sizes,
+        "attrs": attrs,
+    }
@@ -2,9 +2,9 @@ from django.urls import path
 
 from .views import (AddCoupon, CheckoutView, HomeView, ItemByCategory,
                     ItemDetailView, OrderDetailView, OrderSummaryView,
-                    PaymentView, RequestRefundView, Search, UserProfileView,
-                    add_to_cart, remove_from_cart,
-                    remove_single_item_from_cart)
+                    PaymentStatusView, PaymentView, RequestRefundView,
+                    Search, UserProfileView, add_to_cart, metrics,
+                    remove_from_cart, remove_single_item_from_cart)
 
 app_name = "core"
 
@@ -20,11 +20,14 @@ urlpatterns = [
          ),
     path("order-summary/", OrderSummaryView.as_view(), name="order-summary"),
     path("payment/<payment_option>/", PaymentView.as_view(), name="payment"),
+    path("payment-status/<key>/", PaymentStatusView.as_view(),
+         name="payment-status"),
     path("add-coupon/", AddCoupon.as_view(), name="add-coupon"),
     path("request-refund/", RequestRefundView.as_view(),
          name="request-refund"),
     path("category/<slug:slug>/", ItemByCategory.as_view(), name="category"),
     path("search/", Search.as_view(), name="search"),
+    path("metrics/", metrics, name="metrics"),
     path("profile/", UserProfileView.as_view(), name="profile"),
     path("order-detail/<slug:ref_code>/", OrderDetailView.as_view(),
          name="order-detail"
@@ -1,71 +1,124 @@
-import random
-import string
+from urllib.parse import urlencode
 
-import stripe
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
-from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import (Http404, HttpResponse, HttpResponseForbidden,
+                         JsonResponse)
 from django.shortcuts import get_object_or_404, redirect, render
-from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.safestring import mark_safe
 from django.views.generic import DetailView, ListView, View
 
+from . import cart, payments
+from .cache import (CATALOG_VERSION_KEY, CATEGORIES_VERSION_KEY,
+                    CATEGORY_ITEMS_VERSION_KEY, CATEGORY_VERSION_KEY,
+                    ITEM_VERSION_KEY, get_categories, get_versions,
+                    render_item_fragments)
+from .conditional import CatalogConditionalMixin
+from .facets import category_facets, filter_items, parse_filters
 from .forms import CheckoutForm, CouponForm, RefundForm
-from .models import Address, Coupon, Item, Order, OrderItem, Payment, Refund
+from .metrics import render_prometheus
+from .models import Address, Coupon, Item, Order, PaymentTask, Refund
+from .pagination import KeysetPaginationMixin
+from .search import get_search_backend
 
 User = get_user_model()
-# Настройка работы с банковскими картами
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
 
-class HomeView(ListView):
+class HomeView(CatalogConditionalMixin, KeysetPaginationMixin, ListView):
     """Домашняя страница (Отображение товаров)
     context_object_name по умолчанию object_list
     """
 
-    model = Item
+    version_keys = (CATALOG_VERSION_KEY,)
+    queryset = Item.objects.select_related("category")
     template_name = "home.html"
     paginate_by = 8
     context_object_name = "items"
 
 
-class ItemByCategory(ListView):
+class ItemByCategory(CatalogConditionalMixin, KeysetPaginationMixin,
+                     ListView):
     model = Item
     template_name = "home.html"
     paginate_by = 10
     context_object_name = "items"
 
+    def get_category(self):
+        """Категория из кэша навигации (None - такой категории нет)"""
+        slug = self.kwargs.get("slug")
+        return next(
+            (category for category in get_categories()
+             if category.slug == slug), None
+        )
+
+    def get_version_keys(self):
+        """Навигация и товары категории: изменения в других категориях
+        не меняют страницу, если не меняется количество их товаров"""
+        category = self.get_category()
+        if category is None:
+            return [CATEGORIES_VERSION_KEY]
+        return [CATEGORIES_VERSION_KEY,
+                CATEGORY_ITEMS_VERSION_KEY % category.pk]
+
     def get_queryset(self):
-        return Item.objects.filter(category__slug=self.kwargs.get("slug"))
+        """Товары категории с фильтрами по цене, этикетке и скидке"""
+        self.filters = parse_filters(self.request.GET)
+        queryset = Item.objects.select_related("category").filter(
+            category__slug=self.kwargs.get("slug")
+        )
+        return filter_items(queryset, self.filters)
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["cat_selected_slug"] = self.kwargs.get("slug")
+        slug = self.kwargs.get("slug")
+        context["cat_selected_slug"] = slug
+        # Категория берётся из кэша навигации, а счётчики фильтров - из
+        # заранее посчитанной таблицы, без GROUP BY по товарам
+        category = self.get_category()
+        if category is not None:
+            context["facets"] = category_facets(category.pk, self.filters)
+        # Выбранные фильтры сохраняются в ссылках пагинации
+        params = [("label", label) for label in self.filters["label"]]
+        if self.filters["price"]:
+            params.append(("price", self.filters["price"]))
+        if self.filters["discounted"]:
+            params.append(("discounted", "1"))
+        context["q"] = urlencode(params) + "&" if params else ""
         return context
 
 
-class Search(ListView):
+class Search(KeysetPaginationMixin, ListView):
     template_name = "home.html"
     paginate_by = 10
     context_object_name = "items"
+    # Результаты поиска идут по релевантности, id - для однозначности
+    keyset_ordering = ("-rank", "id")
 
     def get_queryset(self):
-        """Фильтруем товары, по полученному запросу, где название содержит
-        запрос полученный из поля ввода в home.html с названием q"""
-        return Item.objects.filter(title__icontains=self.request.GET.get("q"))
+        """Полнотекстовый поиск товаров по названию и описанию. Запрос
+        приходит из поля ввода в home.html с названием q. Результаты
+        отсортированы по релевантности"""
+        query = self.request.GET.get("q", "").strip()
+        if not query:
+            return Item.objects.none()
+        queryset = Item.objects.select_related("category")
+        return get_search_backend(queryset.db).search(queryset, query)
 
     def get_context_data(self, *args, **kwargs):
         """Добавляем в словарь значение, которое пришло. Это нужно для того,
         чтобы работала пагинация. Чтобы она работала, необходимо передать
         контекст как строку, где q будет равно запросу."""
         context = super().get_context_data(*args, **kwargs)
-        context["q"] = f'q={self.request.GET.get("q")}&'
+        query = self.request.GET.get("q", "").strip()
+        context["q"] = urlencode({"q": query}) + "&"
         return context
 
 
-class ItemDetailView(DetailView):
+class ItemDetailView(CatalogConditionalMixin, DetailView):
     """Просмотр определенного товара
     context_object_name по умолчанию object. Тут не переопределён
     """
@@ -73,118 +126,107 @@ class ItemDetailView(DetailView):
     model = Item
     template_name = "product.html"
 
+    def is_public(self, request):
+        # Форма добавления в корзину содержит токен CSRF посетителя
+        return False
+
+    def get_validators(self):
+        """Версии фрагментов товара и время изменения товара или его
+        категории. Товар читается здесь же и второй раз не запрашивается"""
+        self.item = Item.objects.select_related("category").filter(
+            slug=self.kwargs["slug"]
+        ).first()
+        if self.item is None:
+            return None
+        keys = [ITEM_VERSION_KEY % self.item.pk,
+                CATEGORY_VERSION_KEY % self.item.category_id]
+        versions = get_versions(keys)
+        return ([versions[key] for key in keys],
+                max(self.item.updated_at, self.item.category.updated_at))
+
+    def get_object(self, queryset=None):
+        item = getattr(self, "item", None)
+        return item if item is not None else super().get_object(queryset)
+
+    def get_context_data(self, **kwargs):
+        """Изображение и описание товара - готовый HTML из кэша"""
+        context = super().get_context_data(**kwargs)
+        image, info = render_item_fragments([
+            ("item_detail_image.html", self.object),
+            ("item_detail_info.html", self.object),
+        ])
+        context["fragments"] = {
+            "image": mark_safe(image), "info": mark_safe(info)
+        }
+        return context
+
+
+def cart_item_id(slug):
+    """id товара для корзины (404, если такого товара нет)"""
+    item_id = Item.objects.filter(slug=slug).values_list(
+        "pk", flat=True
+    ).first()
+    if item_id is None:
+        raise Http404("Товар не найден")
+    return item_id
+
 
-@login_required
 def add_to_cart(request, slug):
     """Метод добавления в корзину товара по его slug"""
-    item = get_object_or_404(Item, slug=slug)
-    item_quantity = request.POST.get("amount", 1)
+    try:
+        item_quantity = int(request.POST.get("amount", 1))
+    except ValueError:
+        item_quantity = 0
 
-    if int(item_quantity) < 1:
+    if item_quantity < 1:
         messages.warning(request, 'Количество должно быть больше 1')
         return redirect('core:product', slug)
 
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item,
-        user=request.user,
-        ordered=False,
-    )
+    status = cart.get_cart(request).add(cart_item_id(slug), item_quantity)
+    if status == cart.UPDATED:
+        messages.info(request, f"Количество товара было обновлено")
+    else:
+        messages.info(request, "Товар добавлен в вашу корзину")
+    return redirect("core:order-summary")
 
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
 
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += int(item_quantity)
-            order_item.save()
-            messages.info(request, f"Количество товара было обновлено")
-            return redirect("core:order-summary")
-        else:
-            order_item.quantity = item_quantity
-            order.items.add(order_item)
-            order_item.save()
-            messages.info(request, "Товар добавлен в вашу корзину")
-            return redirect("core:order-summary")
-    # Если заказа нет, то создать его вручную и добавить товар в корзину
+def cart_missing_item_redirect(request, status, slug):
+    """Сообщить, почему товар не удалось убрать из корзины"""
+    # Если корзина пуста
+    if status == cart.NO_ORDER:
+        messages.info(request, "У вас нет активного заказа")
+    # Если этого товара нет в корзине
     else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(user=request.user,
-                                     ordered_date=ordered_date)
-        order.items.add(order_item)
-        messages.info(request, "Товар добавлен в вашу корзину")
-        return redirect("core:order-summary")
+        messages.info(request, "Этого предмета нет в вашей корзине")
+    return redirect("core:product", slug=slug)
 
 
-@login_required
 def remove_from_cart(request, slug):
     """Метод удаления товара из корзины (полностью)"""
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # Если товар в корзине существует, то получить этот товар по его slug,
-        # а затем удалить его в 2‑х моделях (В корзине и промежуточной модели)
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False
-            )[0]
-            order.items.remove(order_item)
-            order_item.delete()
-            messages.info(request, "Этот товар был убран из вашей корзины")
-            return redirect("core:order-summary")
-        # Если этого товара нет в корзине
-        else:
-            messages.info(request, "Этого предмета нет в вашей корзине")
-            return redirect("core:product", slug=slug)
-    # Если не создан заказ
-    else:
-        messages.info(request, "У вас нет активного заказа")
-        return redirect("core:product", slug=slug)
+    status = cart.get_cart(request).remove(cart_item_id(slug))
+    if status == cart.REMOVED:
+        messages.info(request, "Этот товар был убран из вашей корзины")
+        return redirect("core:order-summary")
+    return cart_missing_item_redirect(request, status, slug)
 
 
-@login_required
 def remove_single_item_from_cart(request, slug):
-    """Метод удаления одного товара из корзины"""
-    item = get_object_or_404(Item, slug=slug)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # Если товар существует в корзине, то уменьшить его количество на 1.
-        # Если количество равно 0, то удалить его из заказа.
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False
-            )[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order_item.delete()
-                # order.items.remove(order_item)
-            messages.info(request, "Количество этого товара было обновлено")
-            return redirect("core:order-summary")
-        # Если этого товара нет в корзине
-        else:
-            messages.info(request, "Этого предмета нет в вашей корзине")
-            return redirect("core:product", slug=slug)
-    # Если не создан заказ
-    else:
-        messages.info(request, "У вас нет активного заказа")
-        return redirect("core:product", slug=slug)
+    """Метод удаления одного товара из корзины. Если количество равно 0,
+    то товар убирается из заказа"""
+    status = cart.get_cart(request).remove_single(cart_item_id(slug))
+    if status in (cart.UPDATED, cart.REMOVED):
+        messages.info(request, "Количество этого товара было обновлено")
+        return redirect("core:order-summary")
+    return cart_missing_item_redirect(request, status, slug)
 
 
-class OrderSummaryView(LoginRequiredMixin, View):
-    """Просмотреть корзину товаров"""
+class OrderSummaryView(View):
+    """Просмотреть корзину товаров (в том числе анонимному посетителю)"""
 
     def get(self, *args, **kwargs):
-        """Передать объект заказа для отрисовки"""
-        try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            context = {"object": order}
-            return render(self.request, "order_summary.html", context)
-        except ObjectDoesNotExist:
-            messages.warning(self.request, "У вас нет активного заказа")
-            return redirect("core:home")
+        """Передать корзину для отрисовки"""
+        context = {"object": cart.get_cart(self.request).summary()}
+        return render(self.request, "order_summary.html", context)
 
 
 class CheckoutView(LoginRequiredMixin, View):
@@ -192,186 +234,180 @@ class CheckoutView(LoginRequiredMixin, View):
 
     def get(self, *args, **kwargs):
         """Показать форму при GET запросе + вывод формы для купонов по знач."""
-        try:
-            form = CheckoutForm()
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            print("fds")
-            context = {
-                "form": form,
-                "order": order,
-                "coupon_form": CouponForm(),
-                "DISPLAY_COUPON_FORM": True,
-            }
-
-            # Если у пользователя используется адрес доставки по умолчанию
-            shipping_address_qs = Address.objects.filter(
-                user=self.request.user, address_type="S", default=True
-            )
-            if shipping_address_qs.exists():
-                context.update(
-                    {"default_shipping_address": shipping_address_qs[0]})
-
-            # Если у пользователя используется платежный адрес по умолчанию
-            billing_address_qs = Address.objects.filter(
-                user=self.request.user, address_type="B", default=True
-            )
-            if billing_address_qs.exists():
-                context.update(
-                    {"default_billing_address": billing_address_qs[0]})
-
-            return render(self.request, "checkout.html", context)
-
-        except ObjectDoesNotExist:
+        order = cart.get_cart(self.request).summary()
+        if order is None:
             messages.info(self.request, "У вас нет активного заказа")
             return redirect("core:home")
+        context = {
+            "form": CheckoutForm(),
+            "order": order,
+            "coupon_form": CouponForm(),
+            "DISPLAY_COUPON_FORM": True,
+        }
+
+        # Адреса доставки и платежный по умолчанию, если они есть
+        defaults = get_default_addresses(self.request)
+        if "S" in defaults:
+            context["default_shipping_address"] = defaults["S"]
+        if "B" in defaults:
+            context["default_billing_address"] = defaults["B"]
+
+        return render(self.request, "checkout.html", context)
 
     def post(self, *args, **kwargs):
         form = CheckoutForm(self.request.POST or None)
-        try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            if form.is_valid():
-                use_default_shipping = form.cleaned_data.get(
-                    "use_default_shipping")
-                # Если адрес доставки по умолчанию есть, то проверить его
-                if use_default_shipping:
-                    address_qs = Address.objects.filter(
-                        user=self.request.user, address_type="S", default=True
-                    )
-                    if address_qs.exists():
-                        shipping_address = address_qs[0]
-                        order.shipping_address = shipping_address
-                        order.save()
-                    else:
-                        messages.info(self.request,
-                                      "Нет адреса доставки по умолчанию")
-                        return redirect("core:checkout")
-                # Если нет по умолчанию, то просто обработать форму
+        user_cart = cart.get_cart(self.request)
+        if not user_cart.count():
+            messages.warning(self.request, "У вас нет активного заказа")
+            return redirect("core:order-summary")
+        # Адреса собираются в несохранённый заказ, в базу он попадает
+        # из корзины перед переходом к оплате
+        order = Order(user=self.request.user)
+        if form.is_valid():
+            use_default_shipping = form.cleaned_data.get(
+                "use_default_shipping")
+            # Если адрес доставки по умолчанию есть, то проверить его
+            if use_default_shipping:
+                shipping_address = get_default_addresses(self.request).get(
+                    "S")
+                if shipping_address:
+                    order.shipping_address = shipping_address
                 else:
-                    shipping_address1 = form.cleaned_data.get(
-                        "shipping_address")
-                    shipping_address2 = form.cleaned_data.get(
-                        "shipping_address2")
-                    shipping_country = form.cleaned_data.get(
-                        "shipping_country")
-                    shipping_zip = form.cleaned_data.get("shipping_zip")
-
-                    if is_valid_form(
-                            [
-                                shipping_address1,
-                                shipping_country,
-                                shipping_zip,
-                                shipping_country,
-                            ]
-                    ):
-                        shipping_address = Address(
-                            user=self.request.user,
-                            street_address=shipping_address1,
-                            apartment_address=shipping_address2,
-                            country=shipping_country,
-                            zip=shipping_zip,
-                            address_type="S",
-                        )
+                    messages.info(self.request,
+                                  "Нет адреса доставки по умолчанию")
+                    return redirect("core:checkout")
+            # Если нет по умолчанию, то просто обработать форму
+            else:
+                shipping_address1 = form.cleaned_data.get(
+                    "shipping_address")
+                shipping_address2 = form.cleaned_data.get(
+                    "shipping_address2")
+                shipping_country = form.cleaned_data.get(
+                    "shipping_country")
+                shipping_zip = form.cleaned_data.get("shipping_zip")
+
+                if is_valid_form(
+                        [
+                            shipping_address1,
+                            shipping_country,
+                            shipping_zip,
+                            shipping_country,
+                        ]
+                ):
+                    shipping_address = Address(
+                        user=self.request.user,
+                        street_address=shipping_address1,
+                        apartment_address=shipping_address2,
+                        country=shipping_country,
+                        zip=shipping_zip,
+                        address_type="S",
+                    )
+                    shipping_address.save()
+
+                    # Прикрепить адрес доставки к платежу
+                    order.shipping_address = shipping_address
+
+                    set_default_shipping = form.cleaned_data.get(
+                        "set_default_shipping"
+                    )
+                    # Если поставил галочку сохранить
+                    if set_default_shipping:
+                        shipping_address.default = True
                         shipping_address.save()
+                        invalidate_default_addresses(self.request)
 
-                        # Прикрепить адрес доставки к платежу
-                        order.shipping_address = shipping_address
-                        order.save()
-
-                        set_default_shipping = form.cleaned_data.get(
-                            "set_default_shipping"
-                        )
-                        # Если поставил галочку сохранить
-                        if set_default_shipping:
-                            shipping_address.default = True
-                            shipping_address.save()
-
-                    else:
-                        messages.info(self.request,
-                                      "Пожалуйста, заполните все поля")
-
-                # Использовать платежный адрес по умолчанию
-                use_default_billing = form.cleaned_data.get(
-                    "use_default_billing")
-                # Адрес доставки совпадает с платежным
-                same_billing_address = form.cleaned_data.get(
-                    "same_billing_address")
-
-                # Если совпадает, то скопировать его
-                if same_billing_address:
-                    billing_address = shipping_address
-                    # pk = None для удачного копирования
-                    billing_address.pk = None
-                    billing_address.save()
-                    billing_address.address_type = "B"
+                else:
+                    messages.info(self.request,
+                                  "Пожалуйста, заполните все поля")
+
+            # Использовать платежный адрес по умолчанию
+            use_default_billing = form.cleaned_data.get(
+                "use_default_billing")
+            # Адрес доставки совпадает с платежным
+            same_billing_address = form.cleaned_data.get(
+                "same_billing_address")
+
+            # Если совпадает, то скопировать его
+            if same_billing_address:
+                billing_address = shipping_address
+                # pk = None для удачного копирования
+                billing_address.pk = None
+                billing_address.save()
+                billing_address.address_type = "B"
+                billing_address.save()
+                order.billing_address = billing_address
+
+            # Если по умолчанию, то получить его
+            elif use_default_billing:
+                billing_address = get_default_addresses(self.request).get(
+                    "B")
+                if billing_address:
+                    order.billing_address = billing_address
+                else:
+                    messages.info(
+                        self.request, "Нет платежного адреса по умолчанию"
+                    )
+                    return redirect("core:checkout")
+            # Простая обработка формы если не указаны никакие галочки
+            else:
+                billing_address1 = form.cleaned_data.get("billing_address")
+                billing_address2 = form.cleaned_data.get(
+                    "billing_address2")
+                billing_country = form.cleaned_data.get("billing_country")
+                billing_zip = form.cleaned_data.get("billing_zip")
+
+                if is_valid_form(
+                        [billing_address1, billing_country, billing_zip]):
+                    billing_address = Address(
+                        user=self.request.user,
+                        street_address=billing_address1,
+                        apartment_address=billing_address2,
+                        country=billing_country,
+                        zip=billing_zip,
+                        address_type="B",
+                    )
                     billing_address.save()
+
                     order.billing_address = billing_address
-                    order.save()
 
-                # Если по умолчанию, то получить его
-                elif use_default_billing:
-                    address_qs = Address.objects.filter(
-                        user=self.request.user, address_type="B", default=True
+                    set_default_billing = form.cleaned_data.get(
+                        "set_default_billing"
                     )
-                    if address_qs.exists():
-                        billing_address = address_qs[0]
-                        order.billing_address = billing_address
-                        order.save()
-                    else:
-                        messages.info(
-                            self.request, "Нет платежного адреса по умолчанию"
-                        )
-                        return redirect("core:checkout")
-                # Простая обработка формы если не указаны никакие галочки
-                else:
-                    billing_address1 = form.cleaned_data.get("billing_address")
-                    billing_address2 = form.cleaned_data.get(
-                        "billing_address2")
-                    billing_country = form.cleaned_data.get("billing_country")
-                    billing_zip = form.cleaned_data.get("billing_zip")
-
-                    if is_valid_form(
-                            [billing_address1, billing_country, billing_zip]):
-                        billing_address = Address(
-                            user=self.request.user,
-                            street_address=billing_address1,
-                            apartment_address=billing_address2,
-                            country=billing_country,
-                            zip=billing_zip,
-                            address_type="B",
-                        )
+                    if set_default_billing:
+                        billing_address.default = True
                         billing_address.save()
+                        invalidate_default_addresses(self.request)
 
-                        order.billing_address = billing_address
-                        order.save()
-
-                        set_default_billing = form.cleaned_data.get(
-                            "set_default_billing"
-                        )
-                        if set_default_billing:
-                            billing_address.default = True
-                            billing_address.save()
-
-                    else:
-                        messages.info(self.request,
-                                      "Пожалуйста, заполните все поля")
-
-                payment_option = form.cleaned_data.get("payment_option")
-
-                if payment_option == "S":
-                    return redirect("core:payment", payment_option="stripe")
-                elif payment_option == "P":
-                    return redirect("core:payment", payment_option="paypal")
                 else:
-                    messages.warning(self.request,
-                                     "Выбран неверный вариант оплаты")
-                    return redirect("core:checkout")
+                    messages.info(self.request,
+                                  "Пожалуйста, заполните все поля")
+
+            # Заказ записывается в базу только здесь, перед оплатой
+            order_id = user_cart.place_order(
+                self.request.user,
+                order.shipping_address_id,
+                order.billing_address_id,
+            )
+            if order_id is None:
+                messages.warning(
+                    self.request,
+                    "Предыдущий заказ ещё оплачивается, дождитесь результата"
+                )
+                return redirect("core:order-summary")
 
-            messages.warning(self.request, "Не удалось оформить заказ")
-            return redirect("core:checkout")
+            payment_option = form.cleaned_data.get("payment_option")
 
-        except ObjectDoesNotExist:
-            messages.warning(self.request, "У вас нет активного заказа")
-            return redirect("core:order-summary")
+            if payment_option == "S":
+                return redirect("core:payment", payment_option="stripe")
+            elif payment_option == "P":
+                return redirect("core:payment", payment_option="paypal")
+            else:
+                messages.warning(self.request,
+                                 "Выбран неверный вариант оплаты")
+                return redirect("core:checkout")
+
+        messages.warning(self.request, "Не удалось оформить заказ")
+        return redirect("core:checkout")
 
 
 class PaymentView(View):
@@ -380,7 +416,9 @@ class PaymentView(View):
     def get(self, *args, **kwargs):
         """Отображение страницы платежа"""
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.with_totals().with_items().get(
+                user=self.request.user, ordered=False
+            )
             # Нельзя перейти на страницу оплаты если не указал платежный адрес
             if order.billing_address:
                 context = {
@@ -402,91 +440,71 @@ class PaymentView(View):
             return redirect("/")
 
     def post(self, *args, **kwargs):
-        """Обработка платежа"""
+        """Постановка платежа в очередь. Списание выполняет воркер
+        process_payments, а пользователь ждёт результат на странице статуса"""
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            # Получить токен с формы
-            token = self.request.POST.get("stripeToken")
-            # Цена идет в центах, по этому нужно умножить на 100
-            amount = int(order.get_total_sum() * 100)
-            # Создать платёж stripe
-            charge = stripe.Charge.create(
-                amount=amount, currency="usd", source=token  # cents
+            order = Order.objects.with_totals().get(
+                user=self.request.user, ordered=False
             )
-
-            # Создание платежа Django
-            payment = Payment()
-            payment.stripe_charge_id = charge["id"]
-            payment.user = self.request.user
-            payment.amount = order.get_total_sum()
-            payment.save()
-
-            # Получить все товары в заказе и обновить у них значения ordered.
-            # Для того чтобы после заказа если человек добавит еще предметы, то
-            # у него добавлялись новые
-            order_items = order.items.all()
-            order_items.update(ordered=True)
-            for item in order_items:
-                item.save()
-
-            # Прикрепление платежа к заказу
-            order.ordered = True
-            order.payment = payment
-            order.ref_code = create_ref_code()
-            order.save()
-
-            messages.success(self.request, f"Ваш заказ был успешно оплачен!")
-            messages.warning(self.request, f"Код покупки {order.ref_code}")
-            return redirect("/")
-
         except Order.DoesNotExist:
             messages.warning(self.request, "У вас нет активного заказа")
             return redirect("core:home")
 
-        # https://stripe.com/docs/api/errors/handling?lang=python
-        except stripe.error.CardError as e:
-            body = e.json_body
-            err = body.get("error", {})
-            messages.warning(self.request, f"{err.get('message')}")
-            return redirect("/")
+        # Получить токен с формы
+        token = self.request.POST.get("stripeToken")
+        if not token:
+            messages.warning(self.request, "Invalid parameters")
+            return redirect("core:payment", payment_option="stripe")
 
-        except stripe.error.RateLimitError:
-            # Too many requests made to the API too quickly
-            messages.warning(self.request, "Rate limit error")
-            return redirect("/")
+        task = payments.enqueue_charge(order, self.request.user, token)
+        if task is None:
+            messages.warning(self.request,
+                             "Сумма к оплате должна быть больше нуля")
+            return redirect("core:order-summary")
+        return redirect("core:payment-status", key=task.idempotency_key)
 
-        except stripe.error.InvalidRequestError:
-            # Invalid parameters were supplied to Stripe's API
-            messages.warning(self.request, "Invalid parameters")
-            return redirect("/")
 
-        except stripe.error.AuthenticationError:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            messages.warning(self.request, "Not authenticated")
-            return redirect("/")
+class PaymentStatusView(LoginRequiredMixin, View):
+    """Статус платежа из очереди (страница ожидания + JSON для опроса)"""
 
-        except stripe.error.APIConnectionError:
-            # Network communication with Stripe failed
-            messages.warning(self.request, "Network error")
-            return redirect("/")
+    def get(self, *args, **kwargs):
+        task = get_object_or_404(
+            PaymentTask.objects.select_related("order"),
+            idempotency_key=self.kwargs.get("key"),
+            user=self.request.user,
+        )
+        if self.request.GET.get("format") == "json":
+            return JsonResponse({"status": task.status})
 
-        except stripe.error.StripeError:
-            # Display a very generic error to the user, and maybe send
-            # yourself an email
-            messages.warning(
-                self.request,
-                "Something went wrong. "
-                "You were not charged. Please try again.",
-            )
+        if task.status == PaymentTask.SUCCEEDED:
+            # Оплаченные строки корзина убирает сама (BaseCart.settle)
+            messages.success(self.request, f"Ваш заказ был успешно оплачен!")
+            messages.warning(self.request,
+                             f"Код покупки {task.order.ref_code}")
             return redirect("/")
-
-        except Exception:
-            # send an email to ourselves
-            messages.warning(
-                self.request, "A serious error occurred. We have been notifed."
-            )
+        if task.status == PaymentTask.FAILED:
+            messages.warning(self.request, task.error)
             return redirect("/")
+        if task.status == PaymentTask.REVIEW:
+            messages.warning(self.request,
+                             "Не удалось подтвердить платёж. Мы проверим "
+                             "его и сообщим результат")
+            return redirect("/")
+        return render(self.request, "payment_status.html", {"task": task})
+
+
+def get_default_addresses(request):
+    """Адреса пользователя по умолчанию {тип: адрес}: один запрос на
+    весь запрос пользователя"""
+    if not hasattr(request, "_default_addresses"):
+        request._default_addresses = Address.objects.defaults(request.user)
+    return request._default_addresses
+
+
+def invalidate_default_addresses(request):
+    """Перечитать адреса по умолчанию после изменения"""
+    if hasattr(request, "_default_addresses"):
+        del request._default_addresses
 
 
 def get_coupon(request, code):
@@ -497,12 +515,6 @@ def get_coupon(request, code):
         messages.warning(request, "Этого купона не существует")
 
 
-def create_ref_code():
-    """Создания реферального кода (Для поиска заказа)"""
-    return "".join(
-        random.choices(string.ascii_lowercase + string.digits, k=20))
-
-
 def is_valid_form(values):
     valid = True
 
@@ -518,20 +530,15 @@ class AddCoupon(View):
     def post(self, *args, **kwargs):
         form = CouponForm(self.request.POST or None)
         if form.is_valid():
-            try:
-                code = form.cleaned_data.get("code")
-                order = Order.objects.get(user=self.request.user,
-                                          ordered=False)
-                order.coupon = get_coupon(self.request, code)
-                if order.coupon:
-                    order.save()
-                    messages.success(self.request, "Купон успешно активирован")
-                    return redirect("core:checkout")
-                return redirect("core:checkout")
-
-            except ObjectDoesNotExist:
+            user_cart = cart.get_cart(self.request)
+            if not user_cart.count():
                 messages.info(self.request, "У вас нет активного заказа")
                 return redirect("/")
+            coupon = get_coupon(self.request, form.cleaned_data.get("code"))
+            if coupon:
+                user_cart.set_coupon(coupon.pk)
+                messages.success(self.request, "Купон успешно активирован")
+            return redirect("core:checkout")
 
 
 class RequestRefundView(View):
@@ -581,9 +588,9 @@ class UserProfileView(LoginRequiredMixin, ListView):
     context_object_name = "order"
 
     def get_queryset(self):
-        return self.request.user.order_set.select_related(
+        return self.request.user.order_set.with_totals().select_related(
             "user", "billing_address", "payment"
-        ).prefetch_related("items")
+        )
 
 
 class OrderDetailView(LoginRequiredMixin, ListView):
@@ -591,14 +598,32 @@ class OrderDetailView(LoginRequiredMixin, ListView):
     context_object_name = "order"
 
     def get_queryset(self):
-        order = Order.objects.filter(
-            ref_code=self.kwargs.get("ref_code"), user=self.request.user
+        order = (
+            Order.objects.with_totals()
+            .with_items()
+            .select_related("payment", "billing_address")
+            .filter(ref_code=self.kwargs.get("ref_code"),
+                    user=self.request.user)
+            .first()
         )
-        if order.exists():
-            return (
-                order.select_related("payment", "billing_address")
-                .prefetch_related("items")
-                .first()
-            )
+        if order is not None:
+            return order
         messages.warning(self.request, "Такого заказа нет")
         return redirect("core:profile")
+
+
+def metrics(request):
+    """Счётчики производительности в формате Prometheus.
+
+    Доступны персоналу или по заголовку Authorization: Bearer METRICS_TOKEN
+    """
+    token = settings.METRICS_TOKEN
+    header = request.META.get("HTTP_AUTHORIZATION", "")
+    authorized = bool(token) and constant_time_compare(
+        header, "Bearer %s" % token
+    )
+    if not (authorized or request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        render_prometheus(), content_type="text/plain; version=0.0.4"
+    )
@@ -26,18 +26,25 @@ INSTALLED_APPS = [
     "crispy_forms",
     # pip install django-countries
     "django_countries",
+    "rest_framework",
     # Applications
     "core.apps.CoreConfig",
 ]
 
 MIDDLEWARE = [
+    # Первым, чтобы замерять время всех остальных middleware
+    "core.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    # Статика из STATIC_ROOT прямо из gunicorn, до сессий и остальной
+    # обработки запроса
+    "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "core.middleware.ReplicaMiddleware",
 ]
 
 ROOT_URLCONF = "django_encommerce.urls"
@@ -61,6 +68,13 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "django_encommerce.wsgi.application"
 
+# Кэш по умолчанию (в production переопределяется на Redis)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
 LANGUAGE_CODE = "ru"
 TIME_ZONE = "UTC"
 USE_I18N = True
@@ -70,8 +84,15 @@ USE_TZ = True
 # Static files (CSS, JavaScript, Images)
 
 STATIC_URL = "/static/"
-# STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 STATICFILES_DIRS = [os.path.join(BASE_DIR, "static")]
+# collectstatic добавляет в имена файлов хэш содержимого и сжимает их
+# заранее (gzip и brotli). WhiteNoise отдаёт сжатый вариант, а файлам с
+# хэшем - Cache-Control на год (immutable): повторный визит не
+# запрашивает статику вовсе
+STATICFILES_STORAGE = (
+    "whitenoise.storage.CompressedManifestStaticFilesStorage"
+)
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
@@ -89,5 +110,69 @@ LOGIN_REDIRECT_URL = "/"
 EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, "sent_emails")
 
+# Адрес API Stripe. Для локальной проверки оплаты можно указать фейковый
+# сервер, например stripe-mock: STRIPE_API_BASE=http://localhost:12111
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", default="https://api.stripe.com")
+
+# API каталога (/api/v1/): компактный JSON без HTML-интерфейса DRF
+REST_FRAMEWORK = {
+    "DEFAULT_RENDERER_CLASSES": ("rest_framework.renderers.JSONRenderer",),
+    "DEFAULT_PARSER_CLASSES": ("rest_framework.parsers.JSONParser",),
+    "UNAUTHENTICATED_USER": None,
+}
+
+# Где хранится корзина анонимного посетителя: session (в сессии) или cache
+# (в общем кэше по метке в сессии). Корзина вошедшего пользователя всегда
+# хранится в кэше под его id
+CART_BACKEND = os.getenv("CART_BACKEND", default="session")
+# Время жизни корзины в кэше (в секундах)
+CART_TIMEOUT = 60 * 60 * 24 * 30
+
+# Реплики базы только для чтения каталога (задаются в development.py и
+# production.py), см. core.routers
+DATABASE_ROUTERS = ["core.routers.ReplicaRouter"]
+DATABASE_REPLICAS = []
+# Модели, которые читаются с реплик
+REPLICA_MODELS = ("core.item", "core.category", "core.categoryfacet")
+# Представления корзины и оформления заказа читают только основную базу
+PRIMARY_DB_VIEWS = (
+    "core:add-to-cart",
+    "core:remove-from-cart",
+    "core:remove_single_item_from_cart",
+    "core:order-summary",
+    "core:checkout",
+    "core:add-coupon",
+    "core:payment",
+    "core:payment-status",
+)
+# Допустимое отставание реплик, в секундах: столько посетитель после
+# записи читает с основной базы, а свежие версии каталога не кэшируются
+REPLICA_LAG = 10
+
+# Сколько секунд обратный прокси может отдавать страницы каталога из
+# своего кэша посетителям без сессии (Cache-Control: s-maxage)
+CATALOG_PAGE_MAX_AGE = 60
+
+# Метрики производительности (эндпоинт /metrics/ в формате Prometheus).
+# Без токена метрики доступны только персоналу
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", default="")
+# Как часто (в секундах) процесс сбрасывает накопленные счётчики в кэш
+METRICS_FLUSH_INTERVAL = 10
+
+# Бюджеты по имени URL: превышения пишутся в лог core.metrics.
+# Поля: queries, latency_ms, db_ms, stripe_ms
+PERFORMANCE_BUDGETS = {
+    "default": {"queries": 30, "latency_ms": 1000},
+    "core:home": {"queries": 10, "latency_ms": 300},
+    "core:category": {"queries": 10, "latency_ms": 300},
+    "core:search": {"queries": 10, "latency_ms": 500},
+    "core:product": {"queries": 10, "latency_ms": 300},
+    "core:order-summary": {"queries": 15, "latency_ms": 300},
+    "core:checkout": {"queries": 20, "latency_ms": 500},
+    # Stripe вызывается только воркером оплат, не в запросе
+    "core:payment": {"queries": 20, "latency_ms": 500, "stripe_ms": 0},
+    "task:process_payment": {"queries": 20, "stripe_ms": 5000},
+}
+
 # CRISPY FORMS (pip install django-crispy-forms)
 CRISPY_TEMPLATE_PACK = "bootstrap4"
@@ -43,6 +43,16 @@ DATABASES = {
     }
 }
 
+# Проверка чтения с реплики: SQLITE_REPLICA - путь к копии db.sqlite3
+# (копия не обновляется сама, так видно, откуда читается каталог)
+if os.getenv("SQLITE_REPLICA"):
+    DATABASES["replica"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.getenv("SQLITE_REPLICA"),
+        "TEST": {"MIRROR": "default"},
+    }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+
 # https://dashboard.stripe.com/test/dashboard
 STRIPE_PUBLIC_KEY = os.getenv("STRIPE_LIVE_PUBLIC_KEY")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_LIVE_SECRET_KEY")
@@ -21,6 +21,27 @@ DATABASES = {
         "PASSWORD": os.getenv("POSTGRES_PASSWORD", default="postgres"),
         "HOST": os.getenv("DB_HOST", default="db"),
         "PORT": os.getenv("DB_PORT", default="5432"),
+        # Постоянные соединения: по одному на поток воркера gunicorn
+        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", default=60)),
+    }
+}
+
+# Реплики для чтения каталога: DB_REPLICA_HOSTS=replica1,replica2 (те же
+# имя базы, пользователь и пароль, что у основной)
+for number, host in enumerate(
+        filter(None, os.getenv("DB_REPLICA_HOSTS", default="").split(",")),
+        start=1):
+    DATABASES["replica%s" % number] = dict(
+        DATABASES["default"], HOST=host.strip(), TEST={"MIRROR": "default"}
+    )
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+
+# Общий кэш для всех воркеров gunicorn (корзины, версии каталога)
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": os.getenv("REDIS_URL", default="redis://redis:6379/0"),
+        "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient"},
     }
 }
 
@@ -6,6 +6,8 @@ from django.urls import include, path
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("accounts/", include("allauth.urls")),  # allauth
+    # Каталог для мобильного клиента и партнёров (только чтение)
+    path("api/v1/", include("core.api_urls", namespace="api")),
     path("", include("core.urls", namespace="core")),
 ]
 
@@ -2,6 +2,6 @@
 python manage.py makemigrations
 python manage.py migrate
 python manage.py collectstatic --no-input
-gunicorn --bind 0:8000 django_encommerce.wsgi:application
+gunicorn -c gunicorn.conf.py django_encommerce.wsgi:application
 
 exec "$@"
\ No newline at end of file
@@ -0,0 +1,25 @@
+"""Настройки gunicorn: gunicorn -c gunicorn.conf.py django_encommerce.wsgi
+
+Воркеры gthread обслуживают несколько запросов в потоках, поэтому
+медленный запрос к базе занимает один поток, а не весь процесс.
+Каждый поток держит своё соединение с базой (CONN_MAX_AGE), так что
+workers * threads не должно превышать max_connections PostgreSQL
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0:8000")
+worker_class = "gthread"
+workers = int(os.getenv(
+    "GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1
+))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+# Держать соединение с клиентом или прокси между запросами
+keepalive = 5
+timeout = 30
+graceful_timeout = 30
+# Перезапуск воркеров против роста памяти (со сдвигом, чтобы воркеры
+# не перезапускались одновременно)
+max_requests = 2000
+max_requests_jitter = 200
+accesslog = "-"